@@ -55,21 +55,114 @@ CREATE TABLE IF NOT EXISTS alerts (
     INDEX idx_created_time (created_time)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
+-- Incident columns: repeated firings of a rule for the same IP and severity
+-- update one row (see detection_engine.create_alert)
+ALTER TABLE alerts
+ADD COLUMN IF NOT EXISTS log_id INT NULL,
+ADD COLUMN IF NOT EXISTS first_seen DATETIME NULL,
+ADD COLUMN IF NOT EXISTS last_seen DATETIME NULL,
+ADD COLUMN IF NOT EXISTS hit_count INT DEFAULT 1,
+ADD COLUMN IF NOT EXISTS last_notified DATETIME NULL;
+
+ALTER TABLE alerts
+ADD INDEX IF NOT EXISTS idx_incident (rule_name, ip_address, severity, status, last_seen);
+
 -- ============================================================================
--- 4. CREATE LOGS TABLE (if not exists)
+-- 4. CREATE COMPACT LOG STORAGE (log_sources, log_events, logs view)
 -- ============================================================================
-CREATE TABLE IF NOT EXISTS logs (
+-- Events are stored in log_events with the source interned into log_sources
+-- (4-byte id instead of a repeated VARCHAR) and the IP packed into
+-- VARBINARY(16) (4 bytes for IPv4, 16 for IPv6). The `logs` view decodes
+-- both, so read queries keep working unchanged. Writes go to log_events.
+--
+-- Upgrading: an existing `logs` TABLE is renamed to logs_legacy and its rows
+-- are copied into log_events (keeping their ids). Drop logs_legacy once the
+-- data has been verified.
+
+CREATE TABLE IF NOT EXISTS log_sources (
+    id INT UNSIGNED PRIMARY KEY AUTO_INCREMENT,
+    name VARCHAR(255) NOT NULL,
+    UNIQUE KEY uq_name (name)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin;
+
+CREATE TABLE IF NOT EXISTS log_events (
     id INT PRIMARY KEY AUTO_INCREMENT,
     log_time DATETIME DEFAULT CURRENT_TIMESTAMP,
-    source VARCHAR(255),
+    source_id INT UNSIGNED NULL,
     level ENUM('INFO', 'WARNING', 'ERROR', 'CRITICAL') DEFAULT 'INFO',
-    ip_address VARCHAR(45),
+    ip VARBINARY(16) NULL,
     message TEXT,
     INDEX idx_level (level),
-    INDEX idx_source (source),
+    INDEX idx_source_id (source_id),
+    INDEX idx_ip (ip),
     INDEX idx_log_time (log_time)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
+-- IP context from the CSV datasets in enrichment/ (see enrichment.py),
+-- interned like sources: each distinct (site, owner, asn, reputation)
+-- combination is stored once and events point at it
+CREATE TABLE IF NOT EXISTS ip_enrichments (
+    id INT UNSIGNED PRIMARY KEY AUTO_INCREMENT,
+    site VARCHAR(100) NOT NULL DEFAULT '',
+    owner VARCHAR(100) NOT NULL DEFAULT '',
+    asn VARCHAR(100) NOT NULL DEFAULT '',
+    reputation VARCHAR(100) NOT NULL DEFAULT '',
+    UNIQUE KEY uq_context (site, owner, asn, reputation)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin;
+
+ALTER TABLE log_events
+ADD COLUMN IF NOT EXISTS enrichment_id INT UNSIGNED NULL AFTER ip;
+
+-- Source ids were SMALLINT in earlier versions; syslog hostnames alone can
+-- use up 65535 of them
+ALTER TABLE log_sources
+MODIFY COLUMN id INT UNSIGNED NOT NULL AUTO_INCREMENT;
+
+ALTER TABLE log_events
+MODIFY COLUMN source_id INT UNSIGNED NULL;
+
+DELIMITER //
+CREATE PROCEDURE IF NOT EXISTS migrate_legacy_logs()
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.tables
+        WHERE table_schema = DATABASE() AND table_name = 'logs' AND table_type = 'BASE TABLE'
+    ) THEN
+        RENAME TABLE logs TO logs_legacy;
+
+        INSERT IGNORE INTO log_sources (name)
+        SELECT DISTINCT source FROM logs_legacy WHERE source IS NOT NULL;
+
+        INSERT INTO log_events (id, log_time, source_id, level, ip, message)
+        SELECT l.id, l.log_time, s.id, l.level, INET6_ATON(l.ip_address), l.message
+        FROM logs_legacy l
+        LEFT JOIN log_sources s ON s.name = l.source;
+    END IF;
+END //
+DELIMITER ;
+
+CALL migrate_legacy_logs();
+DROP PROCEDURE IF EXISTS migrate_legacy_logs;
+
+-- ip_bin / source_id are exposed so filters can use the log_events indexes
+CREATE OR REPLACE VIEW logs AS
+SELECT
+    e.id,
+    e.log_time,
+    s.name COLLATE utf8mb4_unicode_ci AS source,
+    e.level,
+    INET6_NTOA(e.ip) AS ip_address,
+    e.message,
+    e.source_id,
+    e.ip AS ip_bin,
+    x.site COLLATE utf8mb4_unicode_ci AS site,
+    x.owner COLLATE utf8mb4_unicode_ci AS owner,
+    x.asn COLLATE utf8mb4_unicode_ci AS asn,
+    x.reputation COLLATE utf8mb4_unicode_ci AS reputation
+FROM log_events e
+LEFT JOIN log_sources s ON s.id = e.source_id
+LEFT JOIN ip_enrichments x ON x.id = e.enrichment_id;
+
 -- ============================================================================
 -- 5. CREATE RULES TABLE (if not exists)
 -- ============================================================================
@@ -105,6 +198,11 @@ CREATE TABLE IF NOT EXISTS detection_rules (
     INDEX idx_created_at (created_at)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
+-- Columns used by detection_engine.py / the Add Rule page
+ALTER TABLE detection_rules
+ADD COLUMN IF NOT EXISTS rule_type ENUM('anomaly', 'correlation', 'threshold', 'pattern') DEFAULT 'threshold',
+ADD COLUMN IF NOT EXISTS sequence_steps TEXT NULL;
+
 -- ============================================================================
 -- 7. CREATE ANOMALY_ALERT_STATE TABLE (for tracking anomaly detection state)
 -- ============================================================================
@@ -132,8 +230,66 @@ CREATE TABLE IF NOT EXISTS ip_baselines (
     INDEX idx_updated_at (updated_at)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
+-- EWMA mean/variance state used by detection_engine.detect_anomalies
+ALTER TABLE ip_baselines
+ADD COLUMN IF NOT EXISTS avg_events_per_min FLOAT DEFAULT 0,
+ADD COLUMN IF NOT EXISTS var_events_per_min FLOAT DEFAULT 0,
+ADD COLUMN IF NOT EXISTS sample_count INT DEFAULT 0,
+ADD COLUMN IF NOT EXISTS last_updated DATETIME NULL;
+
 -- ============================================================================
--- 9. INSERT DEFAULT ADMIN USER (only if table is empty)
+-- 9. CREATE DETECTION_PARTITIONS TABLE (for sharded detection workers)
+-- ============================================================================
+-- One row per IP hash partition (detection_engine.NUM_PARTITIONS). A detection
+-- worker owns a partition while lease_expires is in the future. `adopted`
+-- marks a partition held for a worker that died; `reclaim` is set when its own
+-- worker is back, and the adopter then lets the lease run out.
+CREATE TABLE IF NOT EXISTS detection_partitions (
+    partition_id INT PRIMARY KEY,
+    owner VARCHAR(255) NULL,
+    lease_expires DATETIME NULL,
+    adopted BOOLEAN NOT NULL DEFAULT FALSE,
+    reclaim BOOLEAN NOT NULL DEFAULT FALSE,
+    INDEX idx_owner (owner)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+ALTER TABLE detection_partitions
+ADD COLUMN IF NOT EXISTS adopted BOOLEAN NOT NULL DEFAULT FALSE AFTER lease_expires,
+ADD COLUMN IF NOT EXISTS reclaim BOOLEAN NOT NULL DEFAULT FALSE AFTER adopted;
+
+-- ============================================================================
+-- 10. CREATE IP_SKETCHES TABLE (for unique-IP estimates)
+-- ============================================================================
+-- HyperLogLog registers (4096 bytes, or 3 bytes per set register while that is
+-- shorter) per hour bucket and source; source_id 0 holds the all-sources
+-- sketch. Maintained and pruned after 7 days by ingest.py, see ip_sketches.py.
+CREATE TABLE IF NOT EXISTS ip_sketches (
+    bucket_start DATETIME NOT NULL,
+    source_id INT UNSIGNED NOT NULL,
+    registers VARBINARY(4096) NOT NULL,
+    PRIMARY KEY (bucket_start, source_id),
+    INDEX idx_source_bucket (source_id, bucket_start)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+
+ALTER TABLE ip_sketches
+MODIFY COLUMN source_id INT UNSIGNED NOT NULL;
+
+-- ============================================================================
+-- 11. CREATE HEAVY_HITTERS TABLE (for top talkers)
+-- ============================================================================
+-- Space-Saving heavy-hitter counts per minute bucket for the dashboard's top
+-- talkers and /api/top. Maintained by ingest.py, see heavy_hitters.py.
+CREATE TABLE IF NOT EXISTS heavy_hitters (
+    bucket_start DATETIME NOT NULL,
+    dimension ENUM('ip', 'source', 'message') NOT NULL,
+    item VARCHAR(255) NOT NULL,
+    hits INT NOT NULL DEFAULT 0,
+    error INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (dimension, bucket_start, item)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin;
+
+-- ============================================================================
+-- 12. INSERT DEFAULT ADMIN USER (only if table is empty)
 -- ============================================================================
 -- Username: admin
 -- Password: admin123 (CHANGE THIS AFTER FIRST LOGIN!)
@@ -156,7 +312,9 @@ SELECT 'Users table:' as Table_Name, COUNT(*) as Row_Count FROM users
 UNION ALL
 SELECT 'Alerts table:', COUNT(*) FROM alerts
 UNION ALL
-SELECT 'Logs table:', COUNT(*) FROM logs
+SELECT 'Logs table:', COUNT(*) FROM log_events
+UNION ALL
+SELECT 'Log Sources table:', COUNT(*) FROM log_sources
 UNION ALL
 SELECT 'Rules table:', COUNT(*) FROM rules
 UNION ALL
@@ -164,7 +322,13 @@ SELECT 'Detection Rules table:', COUNT(*) FROM detection_rules
 UNION ALL
 SELECT 'Anomaly Alert State table:', COUNT(*) FROM anomaly_alert_state
 UNION ALL
-SELECT 'IP Baselines table:', COUNT(*) FROM ip_baselines;
+SELECT 'IP Baselines table:', COUNT(*) FROM ip_baselines
+UNION ALL
+SELECT 'Detection Partitions table:', COUNT(*) FROM detection_partitions
+UNION ALL
+SELECT 'IP Sketches table:', COUNT(*) FROM ip_sketches
+UNION ALL
+SELECT 'Heavy Hitters table:', COUNT(*) FROM heavy_hitters;
 
 SELECT '' as '';
 SELECT 'SYSTEM USERS:' as Section;
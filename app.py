@@ -1,12 +1,26 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from db import get_connection
 from datetime import datetime, timedelta
 from flask import render_template
 from flask import redirect, url_for
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from werkzeug.security import check_password_hash
-from models.user_model import get_user_by_username, get_user_by_id
+from models.user_model import get_user_by_username, get_user_by_id, invalidate_user, clear_user_cache
 from auth import role_required
+from correlation_engine import compile_step, parse_steps
+from ip_sketches import estimate_unique_ips
+from heavy_hitters import top_items, DIMENSIONS
+from ingest import unsupported_format, iter_records, ingest_records, pack_ip, DECODE_ERRORS
+from ingest import SpoolFull, BodyTooLarge, MAX_BODY_SIZE, start_spool_replayer, start_summary_flusher
+from werkzeug.exceptions import RequestEntityTooLarge
+from export import (
+    EXPORT_FORMATS,
+    LOG_EXPORT_COLUMNS,
+    ALERT_EXPORT_COLUMNS,
+    export_options,
+    export_filename,
+    stream_export,
+)
 import json
 
 
@@ -14,11 +28,17 @@ import json
 app = Flask(__name__)
 
 app.secret_key = "mini_siem_secret_key"
+app.config["MAX_CONTENT_LENGTH"] = MAX_BODY_SIZE
 
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = "login"
 
+# Replays batches spooled to disk while the database was unavailable
+start_spool_replayer()
+# Writes ingest summaries (unique IPs, top talkers) that would otherwise wait for the next batch
+start_summary_flusher()
+
 @login_manager.user_loader
 def load_user(user_id):
     return get_user_by_id(user_id)
@@ -64,12 +84,8 @@ def dashboard():
     """)
     events_per_hour = cursor.fetchone()["count"]
 
-    # Get unique IPs (last 24h)
-    cursor.execute("""
-        SELECT COUNT(DISTINCT ip_address) AS count FROM logs 
-        WHERE log_time >= DATE_SUB(NOW(), INTERVAL 24 HOUR)
-    """)
-    unique_ips = cursor.fetchone()["count"]
+    # Get unique IPs (last 24h), estimated from HyperLogLog sketches
+    unique_ips = estimate_unique_ips(conn, datetime.now() - timedelta(hours=24))
 
     # Get rules triggered (last 24h)
     cursor.execute("""
@@ -112,6 +128,11 @@ def dashboard():
             "time": time_str
         })
 
+    # Noisiest IPs, sources and messages (last 15 min), from heavy-hitter summaries
+    top_ips = top_items(conn, "ip", minutes=15, limit=10)
+    top_sources = top_items(conn, "source", minutes=15, limit=10)
+    top_messages = top_items(conn, "message", minutes=15, limit=10)
+
     cursor.close()
     conn.close()
 
@@ -126,10 +147,30 @@ def dashboard():
         unique_ips=unique_ips,
         rules_triggered=rules_triggered,
         threat_level=threat_level,
-        recent_activities=recent_activities
+        recent_activities=recent_activities,
+        top_ips=top_ips,
+        top_sources=top_sources,
+        top_messages=top_messages
     )
 
 
+@app.route("/api/top/<dimension>")
+@login_required
+def top_talkers(dimension):
+    # e.g. /api/top/ip?minutes=15&limit=20
+    if dimension not in DIMENSIONS:
+        return jsonify({"error": f"dimension must be one of {', '.join(DIMENSIONS)}"}), 400
+
+    minutes = request.args.get("minutes", 15, type=int)
+    limit = request.args.get("limit", 20, type=int)
+
+    conn = get_connection()
+    items = top_items(conn, dimension, minutes=max(1, minutes), limit=max(1, min(limit, 1000)))
+    conn.close()
+
+    return jsonify({"dimension": dimension, "minutes": minutes, "items": items})
+
+
 @app.route("/login", methods=["GET", "POST"])
 def login():
     error = None
@@ -145,6 +186,7 @@ def login():
                 cursor = conn.cursor()
                 cursor.execute("UPDATE users SET last_login = NOW() WHERE id = %s", (user.id,))
                 conn.commit()
+                invalidate_user(user.id)
             except Exception as e:
                 print(f"Failed to update last_login: {e}")
             finally:
@@ -215,14 +257,37 @@ def enable_rule(rule_id):
 @role_required("admin")
 def add_rule():
     if request.method == "POST":
+        rule_type = request.form.get("rule_type", "threshold")
+        sequence_steps = request.form.get("sequence_steps", "").strip() or None
+
+        try:
+            compile_step({
+                "log_field": request.form["log_field"],
+                "match_type": request.form["match_type"],
+                "match_value": request.form["match_value"],
+            })
+        except ValueError as e:
+            return render_template("add_rule.html", error=f"Invalid rule: {e}")
+
+        if rule_type == "correlation":
+            try:
+                if not parse_steps(sequence_steps):
+                    raise ValueError("Correlation rules need at least one follow-up step")
+            except ValueError as e:
+                return render_template("add_rule.html", error=f"Invalid sequence steps: {e}")
+        else:
+            sequence_steps = None
+
         data = (
             request.form["rule_name"],
+            rule_type,
             request.form["log_field"],
             request.form["match_type"],
             request.form["match_value"],
             int(request.form["threshold"]),
             int(request.form["time_window"]),
-            request.form["severity"]
+            request.form["severity"],
+            sequence_steps
         )
 
         conn = get_connection()
@@ -230,8 +295,8 @@ def add_rule():
 
         cursor.execute("""
             INSERT INTO detection_rules
-            (rule_name, log_field, match_type, match_value, threshold, time_window_minutes, severity)
-            VALUES (%s,%s,%s,%s,%s,%s,%s)
+            (rule_name, rule_type, log_field, match_type, match_value, threshold, time_window_minutes, severity, sequence_steps)
+            VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)
         """, data)
 
         conn.commit()
@@ -245,75 +310,101 @@ def add_rule():
 
 @app.route("/api/logs", methods=["POST"])
 def receive_logs():
-    data = request.get_json()
+    # Accepts one event or a batch as JSON, NDJSON or MessagePack, optionally
+    # gzip/zstd compressed (Content-Encoding header)
+    error = unsupported_format(request.mimetype, request.content_encoding)
+    if error:
+        return jsonify({"error": error}), 415
 
-    required_fields = ["source", "level", "message", "ip", "timestamp"]
-    if not data or not all(field in data for field in required_fields):
-        return jsonify({"error": "Invalid log format"}), 400
+    counts = {"accepted": 0, "rejected": 0}
+    try:
+        records = iter_records(request.stream, request.mimetype, request.content_encoding)
+        ingest_records(records, counts)
+    except (BodyTooLarge, RequestEntityTooLarge) as e:
+        return jsonify({"error": f"Request body too large: {e}", **counts}), 413
+    except DECODE_ERRORS as e:
+        return jsonify({"error": f"Invalid log format: {e}", **counts}), 400
+    except SpoolFull:
+        # Database down and the spool is full: ask the sender to retry later
+        return jsonify({"error": "Log storage unavailable, retry later", **counts}), 503
 
-    conn = get_connection()
-    cursor = conn.cursor()
+    if counts["accepted"] == 0:
+        return jsonify({"error": "Invalid log format", **counts}), 400
 
-    query = """
-        INSERT INTO logs (source, level, message, ip_address, log_time)
-        VALUES (%s, %s, %s, %s, %s)
-    """
+    return jsonify({"status": "log saved", **counts}), 201
 
-    values = (
-        data["source"],
-        data["level"],
-        data["message"],
-        data["ip"],
-        data["timestamp"]
-    )
 
-    cursor.execute(query, values)
-    conn.commit()
-    cursor.close()
-    conn.close()
+# ================= FILTERS =================
+# Shared by the /alerts and /logs pages and the export API. Date filters
+# compare the raw timestamp column so its index can be used.
 
-    return jsonify({"status": "log saved"}), 201
+def alert_filters(args):
+    conditions, params = "", []
 
+    if args.get("severity"):
+        conditions += " AND severity = %s"
+        params.append(args["severity"])
 
-@app.route("/alerts")
-@login_required
-def view_alerts():
-    conn = get_connection()
-    cursor = conn.cursor(dictionary=True)
+    if args.get("status"):
+        conditions += " AND status = %s"
+        params.append(args["status"])
 
-    # Get filter parameters from request
-    severity = request.args.get('severity', '')
-    status = request.args.get('status', '')
-    search = request.args.get('search', '')
-    date_from = request.args.get('dateFrom', '')
-    date_to = request.args.get('dateTo', '')
+    if args.get("search"):
+        conditions += " AND (rule_name LIKE %s OR message LIKE %s)"
+        search_param = f"%{args['search']}%"
+        params.extend([search_param, search_param])
 
-    # Build query with filters
-    query = "SELECT * FROM alerts WHERE 1=1"
-    params = []
+    if args.get("dateFrom"):
+        conditions += " AND created_time >= %s"
+        params.append(args["dateFrom"])
 
-    if severity:
-        query += " AND severity = %s"
-        params.append(severity)
+    if args.get("dateTo"):
+        conditions += " AND created_time < DATE_ADD(%s, INTERVAL 1 DAY)"
+        params.append(args["dateTo"])
 
-    if status:
-        query += " AND status = %s"
-        params.append(status)
+    return conditions, params
 
-    if search:
-        query += " AND (rule_name LIKE %s OR message LIKE %s)"
-        search_param = f"%{search}%"
-        params.extend([search_param, search_param])
 
-    if date_from:
-        query += " AND DATE(created_time) >= %s"
-        params.append(date_from)
+def log_filters(args):
+    conditions, params = "", []
 
-    if date_to:
-        query += " AND DATE(created_time) <= %s"
-        params.append(date_to)
+    if args.get("level"):
+        conditions += " AND level = %s"
+        params.append(args["level"])
 
-    query += " ORDER BY created_time DESC"
+    if args.get("source"):
+        conditions += " AND source = %s"
+        params.append(args["source"])
+
+    if args.get("ip"):
+        # Compare the packed form so the log_events IP index is used
+        conditions += " AND ip_bin = %s"
+        params.append(pack_ip(args["ip"]))
+
+    if args.get("search"):
+        conditions += " AND message LIKE %s"
+        params.append(f"%{args['search']}%")
+
+    if args.get("dateFrom"):
+        conditions += " AND log_time >= %s"
+        params.append(args["dateFrom"])
+
+    if args.get("dateTo"):
+        conditions += " AND log_time < DATE_ADD(%s, INTERVAL 1 DAY)"
+        params.append(args["dateTo"])
+
+    return conditions, params
+
+
+@app.route("/alerts")
+@login_required
+def view_alerts():
+    conn = get_connection()
+    cursor = conn.cursor(dictionary=True)
+
+    # Build query with filters
+    conditions, params = alert_filters(request.args)
+    query = f"SELECT * FROM alerts WHERE 1=1{conditions} ORDER BY created_time DESC"
 
     cursor.execute(query, params)
     alerts = cursor.fetchall()
@@ -366,51 +457,82 @@ def view_logs():
     conn = get_connection()
     cursor = conn.cursor(dictionary=True)
 
-    # Get filter parameters from request
-    level = request.args.get('level', '')
-    source = request.args.get('source', '')
-    ip = request.args.get('ip', '')
-    search = request.args.get('search', '')
-    date_from = request.args.get('dateFrom', '')
-    date_to = request.args.get('dateTo', '')
-
     # Build query with filters
-    query = "SELECT * FROM logs WHERE 1=1"
-    params = []
+    conditions, params = log_filters(request.args)
+    query = f"SELECT * FROM logs WHERE 1=1{conditions} ORDER BY log_time DESC LIMIT 10000"
 
-    if level:
-        query += " AND level = %s"
-        params.append(level)
+    cursor.execute(query, params)
+    logs = cursor.fetchall()
 
-    if source:
-        query += " AND source = %s"
-        params.append(source)
+    cursor.close()
+    conn.close()
 
-    if ip:
-        query += " AND ip_address = %s"
-        params.append(ip)
+    return render_template("logs.html", logs=logs)
 
-    if search:
-        query += " AND message LIKE %s"
-        params.append(f"%{search}%")
 
-    if date_from:
-        query += " AND DATE(log_time) >= %s"
-        params.append(date_from)
+# ================= EXPORT =================
+# e.g. /api/export/logs?format=ndjson&gzip=1&level=ERROR&start=2026-10-01T00:00
+# Accepts the same filters as the /logs and /alerts pages plus start/end
+# timestamps. The response is streamed while the rows are read.
 
-    if date_to:
-        query += " AND DATE(log_time) <= %s"
-        params.append(date_to)
+def export_response(name, query, params, columns, fmt, compress):
+    content_type = "application/gzip" if compress else EXPORT_FORMATS[fmt][0]
+    return Response(
+        stream_export(query, params, columns, fmt, compress),
+        mimetype=content_type,
+        headers={
+            "Content-Disposition": f"attachment; filename={export_filename(name, fmt, compress)}",
+            "X-Accel-Buffering": "no",
+        }
+    )
 
-    query += " ORDER BY log_time DESC LIMIT 10000"
 
-    cursor.execute(query, params)
-    logs = cursor.fetchall()
+@app.route("/api/export/logs")
+@login_required
+def export_logs():
+    try:
+        fmt, compress, start, end = export_options(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    conditions, params = log_filters(request.args)
+    if start:
+        conditions += " AND log_time >= %s"
+        params.append(start)
+    if end:
+        conditions += " AND log_time < %s"
+        params.append(end)
+
+    query = f"""
+        SELECT {", ".join(LOG_EXPORT_COLUMNS)} FROM logs
+        WHERE 1=1{conditions}
+        ORDER BY log_time, id
+    """
+    return export_response("logs", query, params, LOG_EXPORT_COLUMNS, fmt, compress)
 
-    cursor.close()
-    conn.close()
 
-    return render_template("logs.html", logs=logs)
+@app.route("/api/export/alerts")
+@login_required
+def export_alerts():
+    try:
+        fmt, compress, start, end = export_options(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    conditions, params = alert_filters(request.args)
+    if start:
+        conditions += " AND created_time >= %s"
+        params.append(start)
+    if end:
+        conditions += " AND created_time < %s"
+        params.append(end)
+
+    query = f"""
+        SELECT {", ".join(ALERT_EXPORT_COLUMNS)} FROM alerts
+        WHERE 1=1{conditions}
+        ORDER BY created_time, id
+    """
+    return export_response("alerts", query, params, ALERT_EXPORT_COLUMNS, fmt, compress)
 
 
 @app.route("/")
@@ -477,7 +599,7 @@ def system_settings():
         elif action == "clear_old_logs":
             days = int(request.form.get("days", 30))
             try:
-                cursor.execute("DELETE FROM logs WHERE DATE(log_time) < DATE_SUB(NOW(), INTERVAL %s DAY)", (days,))
+                cursor.execute("DELETE FROM log_events WHERE DATE(log_time) < DATE_SUB(NOW(), INTERVAL %s DAY)", (days,))
                 conn.commit()
             except Exception as e:
                 conn.rollback()
@@ -537,6 +659,8 @@ def create_user():
             (username, password_hash, role, 1)
         )
         conn.commit()
+        # A re-created username may reuse a cached id after a delete
+        clear_user_cache()
     except Exception as e:
         conn.rollback()
         print(f"Error creating user: {e}")
@@ -588,6 +712,7 @@ def edit_user(user_id):
                     (role, 1 if is_active else 0, user_id)
                 )
             conn.commit()
+            invalidate_user(user_id)
         except Exception as e:
             conn.rollback()
             print(f"Error updating user: {e}")
@@ -612,6 +737,7 @@ def delete_user(user_id):
     try:
         cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
         conn.commit()
+        invalidate_user(user_id)
     except Exception as e:
         conn.rollback()
         print(f"Error deleting user: {e}")
@@ -0,0 +1,339 @@
+from db import get_connection
+from detection_engine import (
+    INCIDENT_WINDOW_MINUTES,
+    ANOMALY_MIN_STDDEV,
+    load_rules,
+    is_stream_rule,
+    score_anomalies,
+    ewma_update,
+)
+from pattern_matcher import PatternMatcher
+from collections import Counter, deque
+from datetime import datetime, timedelta
+import numpy as np
+import argparse
+import time
+
+# Backtest: replay a historical range of logs through threshold rules and the
+# anomaly detector to see which alerts would have fired.
+#
+# Rows are streamed in log_time order from an unbuffered cursor and the
+# detection cycle is simulated: every CYCLE_SECONDS of log time each rule is
+# checked against the counts of its sliding window, exactly as the live engine
+# would have seen them at that moment. Firings are coalesced into incidents
+# like create_alert() does. Nothing is written to the database and no email is
+# sent. Memory depends on the traffic inside the longest rule window and the
+# number of distinct IPs, not on the length of the replayed range.
+#
+# Differences from the live engine: rule values are matched in Python
+# (case-insensitive, like the table collation), so a regex using MySQL-only
+# syntax may behave differently; anomaly baselines start empty, so every IP
+# spends ANOMALY_MIN_SAMPLES cycles warming up before it can alert.
+
+CYCLE_SECONDS = 30          # same cadence as the live engine
+RATE_WINDOW_MINUTES = 5     # calculate_current_rates() window
+FETCH_SIZE = 10000
+SWEEP_CYCLES = 120          # drop idle state once per simulated hour
+
+ANOMALY_RULE_NAME = "Traffic Spike Anomaly Detected"
+ANOMALY_SEVERITY = "MEDIUM"
+
+# ================= THRESHOLD RULES =================
+
+class ThresholdState:
+    """Sliding-window match times per (rule, IP) and the keys currently at threshold."""
+
+    def __init__(self, rules):
+        self.rules = {r["id"]: r for r in rules}
+        self.windows = {r["id"]: timedelta(minutes=r["time_window_minutes"]) for r in rules}
+        self.hits = {}      # (rule id, ip) -> deque of match times
+        self.hot = set()    # keys whose deque has reached the rule's threshold
+
+    def add(self, rule_id, ip, when):
+        key = (rule_id, ip)
+        times = self.hits.get(key)
+        if times is None:
+            times = self.hits[key] = deque()
+        times.append(when)
+        if len(times) >= (self.rules[rule_id]["threshold"] or 1):
+            self.hot.add(key)
+
+    def due(self, now):
+        """Yield (rule, ip, hit_count) for every key at or above threshold at `now`."""
+        for key in list(self.hot):
+            rule_id, ip = key
+            rule = self.rules[rule_id]
+            times = self.hits[key]
+            cutoff = now - self.windows[rule_id]
+            while times and times[0] < cutoff:
+                times.popleft()
+            if len(times) >= (rule["threshold"] or 1):
+                yield rule, ip, len(times)
+            else:
+                self.hot.discard(key)
+
+    def sweep(self, now):
+        for key in [k for k, times in self.hits.items() if not times or times[-1] < now - self.windows[k[0]]]:
+            del self.hits[key]
+            self.hot.discard(key)
+
+    def idle(self):
+        return not self.hot
+
+# ================= ANOMALY DETECTION =================
+
+class BaselineState:
+    """Per-IP event rates over the rate window plus in-memory EWMA baselines."""
+
+    def __init__(self, window_minutes=RATE_WINDOW_MINUTES):
+        self.window_minutes = window_minutes
+        self.window = timedelta(minutes=window_minutes)
+        self.recent = deque()       # (log_time, ip) inside the rate window
+        self.counts = Counter()
+        self.slots = {}             # ip -> index into the baseline arrays
+        self.mean = np.zeros(1024, dtype=np.float64)
+        self.var = np.zeros(1024, dtype=np.float64)
+        self.samples = np.zeros(1024, dtype=np.int64)
+
+    def add(self, ip, when):
+        self.recent.append((when, ip))
+        self.counts[ip] += 1
+
+    def _slot(self, ip):
+        slot = self.slots.get(ip)
+        if slot is None:
+            slot = self.slots[ip] = len(self.slots)
+            if slot == len(self.mean):
+                self.mean = np.resize(self.mean, slot * 2)
+                self.var = np.resize(self.var, slot * 2)
+                self.samples = np.resize(self.samples, slot * 2)
+                self.mean[slot:] = self.var[slot:] = self.samples[slot:] = 0
+        return slot
+
+    def step(self, now):
+        """Score and update baselines as of `now`; return the anomalous IPs."""
+        cutoff = now - self.window
+        while self.recent and self.recent[0][0] < cutoff:
+            _when, ip = self.recent.popleft()
+            self.counts[ip] -= 1
+            if not self.counts[ip]:
+                del self.counts[ip]
+        if not self.counts:
+            return []
+
+        ips = list(self.counts)
+        current = np.fromiter((self.counts[ip] for ip in ips), dtype=np.float64, count=len(ips))
+        current /= self.window_minutes
+        slots = np.fromiter((self._slot(ip) for ip in ips), dtype=np.int64, count=len(ips))
+
+        mean, var, samples = self.mean[slots], self.var[slots], self.samples[slots]
+        z, anomalous = score_anomalies(current, mean, var, samples)
+        self.mean[slots], self.var[slots], self.samples[slots] = ewma_update(current, mean, var, samples)
+
+        return [
+            (ips[i], current[i], mean[i], np.sqrt(max(var[i], ANOMALY_MIN_STDDEV ** 2)), z[i])
+            for i in np.flatnonzero(anomalous)
+        ]
+
+    def idle(self):
+        return not self.recent
+
+# ================= INCIDENTS =================
+
+class IncidentLog:
+    """Coalesce simulated firings the way create_alert() does and report them."""
+
+    def __init__(self, quiet=False):
+        self.quiet = quiet
+        self.window = timedelta(minutes=INCIDENT_WINDOW_MINUTES)
+        self.open = {}              # (rule, ip, severity) -> [first, last, firings, peak]
+        self.incidents = Counter()  # rule -> incidents
+        self.firings = Counter()    # rule -> firings
+
+    def fire(self, rule, severity, ip, now, peak):
+        self.firings[rule] += 1
+        key = (rule, ip, severity)
+        incident = self.open.get(key)
+        if incident is not None and now - incident[1] <= self.window:
+            incident[1] = now
+            incident[2] += 1
+            incident[3] = max(incident[3], peak)
+            return
+        if incident is not None:
+            self._report(key, incident)
+        self.open[key] = [now, now, 1, peak]
+        self.incidents[rule] += 1
+
+    def close_stale(self, now):
+        for key in [k for k, inc in self.open.items() if now - inc[1] > self.window]:
+            self._report(key, self.open.pop(key))
+
+    def close_all(self):
+        for key in sorted(self.open, key=lambda k: self.open[k][0]):
+            self._report(key, self.open[key])
+        self.open = {}
+
+    def _report(self, key, incident):
+        if self.quiet:
+            return
+        rule, ip, severity = key
+        first, last, firings, peak = incident
+        print(
+            f"[{severity:<8}] {first:%Y-%m-%d %H:%M:%S} -> {last:%H:%M:%S}  {rule}"
+            f"  ip={ip}  firings={firings}  peak={peak:g}"
+        )
+
+# ================= REPLAY =================
+
+def cycle_at_or_after(start, cycle, when):
+    """First simulated cycle time >= when."""
+    return start + cycle * -(-(when - start) // cycle)
+
+
+def backtest(start, end, rules, anomalies=True, quiet=False):
+    matcher = PatternMatcher()
+    matcher.set_rules(rules)
+    thresholds = ThresholdState(list(matcher.rules.values()))
+    baselines = BaselineState() if anomalies else None
+    incidents = IncidentLog(quiet=quiet)
+
+    cycle = timedelta(seconds=CYCLE_SECONDS)
+    cycles = 0
+
+    def run_cycle(now):
+        nonlocal cycles
+        cycles += 1
+        for rule, ip, hit_count in thresholds.due(now):
+            incidents.fire(rule["rule_name"], rule["severity"], ip, now, hit_count)
+        if baselines is not None:
+            for ip, _rate, _baseline, _stddev, z in baselines.step(now):
+                incidents.fire(ANOMALY_RULE_NAME, ANOMALY_SEVERITY, ip, now, round(float(z), 2))
+        if cycles % SWEEP_CYCLES == 0:
+            thresholds.sweep(now)
+            incidents.close_stale(now)
+
+    def idle():
+        return thresholds.idle() and (baselines is None or baselines.idle())
+
+    conn = get_connection()
+    cursor = conn.cursor(dictionary=True)
+
+    # The default cursor is unbuffered, so rows are streamed from the server
+    # FETCH_SIZE at a time instead of materializing the whole range
+    cursor.execute("""
+        SELECT log_time, source, level, ip_address, message
+        FROM logs
+        WHERE log_time >= %s AND log_time < %s
+        ORDER BY log_time, id
+    """, (start, end))
+
+    started = time.time()
+    rows_read = 0
+    next_cycle = start + cycle
+
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        rows_read += len(rows)
+
+        for row in rows:
+            when = row["log_time"]
+            while when > next_cycle:
+                run_cycle(next_cycle)
+                next_cycle += cycle
+                if idle() and when > next_cycle:
+                    # Nothing in any window: jump over the quiet stretch
+                    next_cycle = cycle_at_or_after(start, cycle, when)
+
+            ip = row["ip_address"]
+            if ip is None:
+                continue    # not attributable to an IP, as in the live engine
+            for rule_id in matcher.match(row):
+                thresholds.add(rule_id, ip, when)
+            if baselines is not None:
+                baselines.add(ip, when)
+
+    cursor.close()
+    conn.close()
+
+    # Let the windows still open at the end of the range run out
+    while next_cycle <= end and not idle():
+        run_cycle(next_cycle)
+        next_cycle += cycle
+    incidents.close_all()
+
+    elapsed = time.time() - started
+    return {
+        "rows": rows_read,
+        "cycles": cycles,
+        "seconds": elapsed,
+        "incidents": incidents.incidents,
+        "firings": incidents.firings,
+    }
+
+# ================= CLI =================
+
+def load_backtest_rules(rule_ids):
+    """Threshold rules to replay: the given ids (enabled or not), or all enabled ones."""
+    if not rule_ids:
+        rules = load_rules()
+    else:
+        conn = get_connection()
+        cursor = conn.cursor(dictionary=True)
+        placeholders = ", ".join(["%s"] * len(rule_ids))
+        cursor.execute(f"SELECT * FROM detection_rules WHERE id IN ({placeholders})", list(rule_ids))
+        rules = cursor.fetchall()
+        cursor.close()
+        conn.close()
+
+        missing = set(rule_ids) - {r["id"] for r in rules}
+        if missing:
+            print(f"[BACKTEST] No rules with id {sorted(missing)}")
+
+    for rule in rules:
+        if is_stream_rule(rule):
+            print(f"[BACKTEST] Skipping {rule.get('rule_type')} rule {rule['rule_name']}: only threshold rules are replayed")
+    return [r for r in rules if not is_stream_rule(r)]
+
+
+def parse_time(value):
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid time {value!r}, use YYYY-MM-DD[ HH:MM[:SS]]")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay historical logs through detection rules without raising alerts")
+    parser.add_argument("--start", type=parse_time, help="start of the range (default: --days before --end)")
+    parser.add_argument("--end", type=parse_time, help="end of the range (default: now)")
+    parser.add_argument("--days", type=float, default=1, help="length of the range when --start is not given")
+    parser.add_argument("--rule", type=int, action="append", dest="rule_ids", metavar="ID",
+                        help="detection rule id to replay (repeatable, default: all enabled threshold rules)")
+    parser.add_argument("--no-rules", action="store_true", help="only replay the anomaly detector")
+    parser.add_argument("--no-anomaly", action="store_true", help="do not replay the anomaly detector")
+    parser.add_argument("--quiet", action="store_true", help="print only the summary")
+    args = parser.parse_args()
+
+    end = args.end or datetime.now()
+    start = args.start or end - timedelta(days=args.days)
+    if start >= end:
+        parser.error("--start must be before --end")
+
+    rules = [] if args.no_rules else load_backtest_rules(args.rule_ids)
+    if not rules and args.no_anomaly:
+        parser.error("nothing to replay")
+
+    print(f"Backtesting {len(rules)} rules{'' if args.no_anomaly else ' + anomaly detection'} from {start} to {end}...")
+    result = backtest(start, end, rules, anomalies=not args.no_anomaly, quiet=args.quiet)
+
+    rate = result["rows"] / result["seconds"] if result["seconds"] else 0
+    print("\n" + "=" * 70)
+    print(f"Replayed {result['rows']} logs over {result['cycles']} detection cycles "
+          f"in {result['seconds']:.1f}s ({rate:,.0f} logs/s)")
+    print("=" * 70)
+    if not result["incidents"]:
+        print("No alerts would have fired.")
+    for rule, count in result["incidents"].most_common():
+        print(f"{rule:<40} {count:>6} incidents  {result['firings'][rule]:>8} firings")
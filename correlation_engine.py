@@ -0,0 +1,182 @@
+from collections import OrderedDict
+from datetime import timedelta
+import json
+import re
+
+# Multi-step sequence detection ("5 failed logins, then a success from the
+# same IP within 10 minutes"). Each correlation rule is a list of steps; every
+# IP gets a small state machine per rule that advances as matching events
+# arrive. Partial matches expire after the rule's time window and the total
+# number of tracked (rule, IP) pairs is capped with LRU eviction, so memory
+# stays bounded and each event costs O(number of correlation rules). Steps
+# match case-insensitively, like threshold and pattern rules.
+
+MAX_STATE_ENTRIES = 100000
+
+LOG_FIELDS = ("source", "level", "ip_address", "message")
+MATCH_TYPES = ("equals", "contains", "regex")
+
+
+# ================= RULE PARSING =================
+
+def compile_step(step):
+    field = step.get("log_field", "message")
+    match_type = step.get("match_type", "contains")
+    value = step.get("match_value")
+    count = step.get("count", 1)
+
+    # Steps come from admin-supplied JSON, so check types before using them
+    if not isinstance(field, str) or field not in LOG_FIELDS:
+        raise ValueError(f"Unknown log field: {field!r}")
+    if not isinstance(match_type, str) or match_type not in MATCH_TYPES:
+        raise ValueError(f"Unknown match type: {match_type!r}")
+    if not isinstance(value, str) or value == "":
+        raise ValueError("Each step needs a text match_value")
+    if isinstance(count, bool) or not isinstance(count, int):
+        raise ValueError("Step count must be a whole number")
+    if count < 1:
+        raise ValueError("Step count must be at least 1")
+
+    lowered = value.lower()
+    if match_type == "equals":
+        test = lambda v: v.lower() == lowered
+    elif match_type == "contains":
+        test = lambda v: lowered in v.lower()
+    else:
+        try:
+            pattern = re.compile(value, re.IGNORECASE)
+        except re.error as e:
+            raise ValueError(f"Invalid regex {value!r}: {e}")
+        test = lambda v: pattern.search(v) is not None
+
+    return {
+        "log_field": field,
+        "match_type": match_type,
+        "match_value": value,
+        "count": count,
+        "test": test,
+    }
+
+
+def parse_steps(text):
+    """Parse the JSON list of follow-up steps stored in detection_rules.sequence_steps."""
+    if not text or not text.strip():
+        return []
+    steps = json.loads(text)
+    if isinstance(steps, dict):
+        steps = [steps]
+    if not isinstance(steps, list) or not all(isinstance(s, dict) for s in steps):
+        raise ValueError("Sequence steps must be a JSON object or list of objects")
+    return [compile_step(s) for s in steps]
+
+
+def rule_steps(rule):
+    """Step 1 comes from the rule's own field/match/threshold; the rest from sequence_steps."""
+    first = compile_step({
+        "log_field": rule["log_field"],
+        "match_type": rule["match_type"],
+        "match_value": rule["match_value"],
+        "count": rule["threshold"] or 1,
+    })
+    return [first] + parse_steps(rule.get("sequence_steps"))
+
+
+def describe_steps(steps):
+    return " -> ".join(
+        f"{s['log_field']} {s['match_type']} '{s['match_value']}' x{s['count']}" for s in steps
+    )
+
+# ================= STATE MACHINES =================
+
+class CorrelationEngine:
+    def __init__(self, max_entries=MAX_STATE_ENTRIES):
+        self.max_entries = max_entries
+        self.rules = {}             # rule id -> (rule, steps, window)
+        self._signatures = {}       # rule id -> definition the steps were built from
+        self.state = OrderedDict()  # (rule id, ip) -> [step, count, started, last_seen]
+        self.evicted = 0
+
+    def set_rules(self, rules):
+        """Load correlation rules, recompiling only those whose definition changed."""
+        active = {}
+        for rule in rules:
+            signature = (
+                rule["rule_name"], rule["severity"], rule["log_field"], rule["match_type"], rule["match_value"],
+                rule["threshold"], rule["time_window_minutes"], rule.get("sequence_steps"),
+            )
+            if self._signatures.get(rule["id"]) == signature:
+                active[rule["id"]] = self.rules[rule["id"]]
+                continue
+            try:
+                steps = rule_steps(rule)
+            except ValueError as e:
+                print(f"[CORRELATION] Skipping rule {rule['rule_name']}: {e}")
+                continue
+            active[rule["id"]] = (rule, steps, timedelta(minutes=rule["time_window_minutes"]))
+            self._signatures[rule["id"]] = signature
+            # Definition changed: partial matches for the old steps no longer apply
+            self._drop_rule_state(rule["id"])
+
+        for rule_id in set(self.rules) - set(active):
+            self._signatures.pop(rule_id, None)
+            self._drop_rule_state(rule_id)
+
+        self.rules = active
+
+    def _drop_rule_state(self, rule_id):
+        for key in [k for k in self.state if k[0] == rule_id]:
+            del self.state[key]
+
+    def process(self, event):
+        """Feed one log row; return a list of (rule, steps, state) for completed sequences."""
+        ip = event["ip_address"]
+        now = event["log_time"]
+        fired = []
+
+        for rule_id, (rule, steps, window) in self.rules.items():
+            key = (rule_id, ip)
+            entry = self.state.get(key)
+
+            if entry is not None and now - entry[2] > window:
+                del self.state[key]
+                entry = None
+
+            step_index = entry[0] if entry is not None else 0
+            step = steps[step_index]
+            value = event.get(step["log_field"])
+            if value is None or not step["test"](str(value)):
+                continue
+
+            if entry is None:
+                entry = [0, 0, now, now]
+                self.state[key] = entry
+                if len(self.state) > self.max_entries:
+                    self.state.popitem(last=False)
+                    self.evicted += 1
+
+            entry[1] += 1
+            entry[3] = now
+            self.state.move_to_end(key)
+
+            if entry[1] >= step["count"]:
+                entry[0] += 1
+                entry[1] = 0
+                if entry[0] == len(steps):
+                    del self.state[key]
+                    fired.append((rule, steps, entry))
+
+        return fired
+
+    def expire(self, now):
+        """Drop partial matches that started longer ago than their rule's window.
+
+        The LRU order is by last touch, not by start time, and windows differ
+        per rule, so every entry is checked.
+        """
+        stale = []
+        for key, entry in self.state.items():
+            _rule, _steps, window = self.rules.get(key[0], (None, None, None))
+            if window is None or now - entry[2] > window:
+                stale.append(key)
+        for key in stale:
+            del self.state[key]
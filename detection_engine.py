@@ -1,6 +1,13 @@
 from db import get_connection
+from correlation_engine import CorrelationEngine, describe_steps
+from pattern_matcher import PatternMatcher, PatternHitCounter
+from enrichment import describe_ip
+from collections import Counter, deque
+import mysql.connector
 from datetime import datetime, timedelta
 import time
+import zlib
+import numpy as np
 import smtplib
 from email.message import EmailMessage
 
@@ -41,35 +48,112 @@ def send_email_alert(subject, body):
         server.send_message(msg)
 
 # ================= ALERT CREATION =================
+# Repeated firings of the same rule for the same IP and severity are coalesced
+# into one incident row: while firings keep arriving within
+# INCIDENT_WINDOW_MINUTES of the previous one, the open alert's hit_count and
+# last_seen are updated instead of inserting a new row. Each incident notifies
+# (terminal banner + email) when it opens and then at most once every
+# NOTIFY_INTERVAL_MINUTES.
+
+INCIDENT_WINDOW_MINUTES = 5
+NOTIFY_INTERVAL_MINUTES = 15
+ALERT_LOCK_ATTEMPTS = 3     # GET_LOCK waits up to 10s per attempt
 
-def create_alert(cursor, rule, severity, details=None):
-    now = datetime.now()
 
+def record_incident(cursor, rule, severity, details, ip, now):
+    """Open an incident or add a hit to the open one; return (notify, first_seen, hit_count)."""
     check_query = """
-        SELECT id FROM alerts
-        WHERE rule_name = %s AND status = 'OPEN'
-        AND created_time >= %s
+        SELECT id, hit_count, last_notified FROM alerts
+        WHERE rule_name = %s AND ip_address <=> %s AND severity = %s
+        AND status = 'OPEN' AND last_seen >= %s
+        ORDER BY last_seen DESC
+        LIMIT 1
+        FOR UPDATE
     """
 
-    recent_time = now - timedelta(minutes=5)
-    cursor.execute(check_query, (rule, recent_time))
+    recent_time = now - timedelta(minutes=INCIDENT_WINDOW_MINUTES)
+    cursor.execute(check_query, (rule, ip, severity, recent_time))
+    incident = cursor.fetchone()
+
+    if incident:
+        hit_count = (incident["hit_count"] or 1) + 1
+        last_notified = incident["last_notified"]
+        notify = last_notified is None or now - last_notified >= timedelta(minutes=NOTIFY_INTERVAL_MINUTES)
+
+        cursor.execute("""
+            UPDATE alerts
+            SET hit_count = %s, last_seen = %s, message = COALESCE(%s, message),
+                last_notified = IF(%s, %s, last_notified)
+            WHERE id = %s
+        """, (hit_count, now, details, notify, now, incident["id"]))
 
-    if cursor.fetchone():
-        return  # prevent duplicate alerts
+        return notify, None, hit_count
 
     insert_query = """
-        INSERT INTO alerts (rule_name, severity, log_id, created_time, status)
-        VALUES (%s, %s, NULL, %s, %s)
+        INSERT INTO alerts
+        (rule_name, severity, log_id, created_time, status, message, ip_address,
+         first_seen, last_seen, hit_count, last_notified)
+        VALUES (%s, %s, NULL, %s, %s, %s, %s, %s, %s, %s, %s)
     """
 
-    cursor.execute(insert_query, (rule, severity, now, "OPEN"))
-    
+    cursor.execute(insert_query, (rule, severity, now, "OPEN", details, ip, now, now, 1, now))
+    return True, now, 1
+
+
+def create_alert(conn, cursor, rule, severity, details=None, ip=None):
+    now = datetime.now()
+
+    # Site / owner / ASN / reputation of the IP from the enrichment datasets
+    context = describe_ip(ip)
+    if context:
+        details = f"{details}\n{context}" if details else context
+
+    # Serialize the incident lookup across detection workers. The named lock
+    # and the row lock are held only while the incident is recorded; both are
+    # released before the notification goes out, so a slow mail server does
+    # not hold up other workers.
+    lock_key = f"{rule}|{ip}|{severity}"
+    lock_name = f"mini_siem_alert_{zlib.crc32(lock_key.encode()):08x}"
+    locked = False
+    for _attempt in range(ALERT_LOCK_ATTEMPTS):
+        try:
+            cursor.execute("SELECT GET_LOCK(%s, 10) AS locked", (lock_name,))
+            locked = cursor.fetchone()["locked"] == 1
+        except mysql.connector.errors.DatabaseError as e:
+            # e.g. ER_USER_LOCK_DEADLOCK; the lock was not granted
+            print(f"[ALERT] GET_LOCK({lock_name}) failed: {e}")
+        if locked:
+            break
+    if not locked:
+        # Without the lock two workers could open duplicate incidents
+        print(f"[ALERT] Skipping {rule} for {ip}: could not lock its incident ({lock_name})")
+        return
+
+    try:
+        notify, first_seen, hit_count = record_incident(cursor, rule, severity, details, ip, now)
+        conn.commit()
+    except mysql.connector.errors.DatabaseError as e:
+        conn.rollback()
+        print(f"[ALERT] Could not record {rule} for {ip}: {e}")
+        return
+    finally:
+        try:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (lock_name,))
+            cursor.fetchall()
+        except mysql.connector.Error:
+            pass    # the lock goes away with the connection anyway
+
+    if not notify:
+        return
+
     # Print formatted alert to terminal
     print("\n" + "="*70)
-    print(f"🚨 SECURITY ALERT: {rule}")
+    print(f"🚨 SECURITY ALERT: {rule}" + ("" if first_seen else f" (ongoing, {hit_count} hits)"))
     print("="*70)
     print(f"Severity:  {severity}")
     print(f"Time:      {now.strftime('%Y-%m-%d %H:%M:%S')}")
+    if ip:
+        print(f"IP:        {ip}")
     
     if details:
         print("\n--- DETAILS ---")
@@ -81,15 +165,23 @@ def create_alert(cursor, rule, severity, details=None):
         f"Rule: {rule}\n"
         f"Severity: {severity}\n"
         f"Time: {now}\n"
+        f"Hit Count: {hit_count}\n"
     )
 
+    if ip:
+        body += f"IP Address: {ip}\n"
+
     if details:
         body += f"\nDetails:\n{details}\n"
 
-    send_email_alert(
-        subject=f"SIEM Alert: {rule}",
-        body=body
-    )
+    try:
+        send_email_alert(
+            subject=f"SIEM Alert: {rule}" if first_seen else f"SIEM Alert (ongoing, {hit_count} hits): {rule}",
+            body=body
+        )
+    except (smtplib.SMTPException, OSError) as e:
+        # The alert is already recorded; only the email is lost
+        print(f"[ALERT] Failed to send email for {rule}: {e}")
 
 
 # ================= LOAD RULES FROM DB =================
@@ -106,31 +198,190 @@ def load_rules():
 
     return rules
 
+# ================= IP PARTITIONING =================
+
+# The IP space is split into NUM_PARTITIONS hash buckets so detection can run
+# in several worker processes (see detection_workers.py). Every detector
+# works per IP, so events whose ip did not parse (stored as NULL) are left
+# out rather than lumped together under one None "IP". The evaluators take
+# a keep_alive callback that runs before each alert, so a worker can renew
+# its partition leases while a long cycle is still sending alerts.
+NUM_PARTITIONS = 64
+
+
+def partition_filter(partitions):
+    """SQL condition and params restricting logs to the given partitions (None = all)."""
+    if partitions is None:
+        return "", []
+    if not partitions:
+        return " AND FALSE", []
+    placeholders = ", ".join(["%s"] * len(partitions))
+    return (
+        f" AND MOD(CRC32(ip_address), {NUM_PARTITIONS}) IN ({placeholders})",
+        list(partitions)
+    )
+
+# ================= INCREMENTAL WINDOW COUNTS =================
+# evaluate_rule() and calculate_current_rates() keep their window's per-IP
+# counts in memory, bucketed by COUNT_BUCKET_SECONDS of log_time, with a
+# high-water mark on logs.id. Each cycle reads only rows above the mark and
+# drops buckets that have left the window, so the rows read per cycle follow
+# the ingest rate rather than the window length. The whole window is scanned
+# only on the first cycle, when a rule's definition or the partition set
+# changes, or when the mark is past MAX(id) (logs were truncated). Counts
+# can include up to one bucket of events just older than the window.
+#
+# Auto-increment ids are handed out at INSERT time but become visible at
+# COMMIT, so MAX(id) can be ahead of rows another writer has not committed
+# yet. The mark therefore only moves up to the MAX(id) seen at least
+# COMMIT_MARGIN_SECONDS ago; rows above it are re-read every cycle one by
+# one and counted once via the set of ids already seen. Residual risk: a
+# write transaction that stays open longer than COMMIT_MARGIN_SECONDS, or is
+# still open during the first full scan after startup, has its rows missed.
+
+COUNT_BUCKET_SECONDS = 10
+COUNT_EPOCH = datetime(2000, 1, 1)
+COMMIT_MARGIN_SECONDS = 30
+
+_id_samples = deque()   # (monotonic time, MAX(log_events.id)), oldest first
+
+
+def settled_log_id(max_id):
+    """Record max_id; return the MAX(id) from COMMIT_MARGIN_SECONDS ago, or None if none is that old."""
+    now = time.monotonic()
+    if _id_samples and max_id < _id_samples[-1][1]:
+        _id_samples.clear()     # logs were truncated
+    _id_samples.append((now, max_id))
+
+    cutoff = now - COMMIT_MARGIN_SECONDS
+    while len(_id_samples) > 1 and _id_samples[1][0] <= cutoff:
+        _id_samples.popleft()
+    return _id_samples[0][1] if _id_samples[0][0] <= cutoff else None
+
+
+class WindowCounts:
+    def __init__(self, key, window):
+        self.key = key              # definition the counts belong to; a change forces a rescan
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.scanned = False        # the window has had its full scan
+        self.last_id = 0            # every matching row up to this id is counted
+        self.max_id = 0             # MAX(id) at the previous scan
+        self.seen = set()           # ids above last_id that are already counted
+        self.buckets = {}           # bucket number -> Counter(ip -> hits)
+        self.totals = Counter()     # ip -> hits over all buckets
+
+    def add(self, ip, bucket, hits):
+        self.buckets.setdefault(bucket, Counter())[ip] += hits
+        self.totals[ip] += hits
+
+    def expire(self, now):
+        """Drop buckets that ended before the start of the window."""
+        cutoff = int((now - self.window - COUNT_EPOCH).total_seconds()) // COUNT_BUCKET_SECONDS
+        for bucket in [b for b in self.buckets if b < cutoff]:
+            for ip, hits in self.buckets.pop(bucket).items():
+                self.totals[ip] -= hits
+                if self.totals[ip] <= 0:
+                    del self.totals[ip]
+
+
+def scan_window(cursor, counts, condition="", params=(), partitions=None):
+    """Add the logs matching condition that are not counted yet, then expire old buckets."""
+    now = datetime.now()
+
+    cursor.execute("SELECT COALESCE(MAX(id), 0) AS max_id FROM log_events")
+    max_id = cursor.fetchone()["max_id"]
+    if max_id < counts.max_id:
+        counts.reset()
+    settled = settled_log_id(max_id)
+
+    partition_sql, partition_params = partition_filter(partitions)
+    filters = f"log_time >= %s AND ip_bin IS NOT NULL{condition}{partition_sql}"
+    filter_params = (now - counts.window, *params, *partition_params)
+
+    if not counts.scanned:
+        # Right after startup there is no older sample, so the full scan
+        # has to trust the current MAX(id)
+        floor = max_id if settled is None else settled
+        cursor.execute(f"""
+            SELECT ip_address,
+                   TIMESTAMPDIFF(SECOND, %s, log_time) DIV {COUNT_BUCKET_SECONDS} AS bucket,
+                   COUNT(*) AS hits
+            FROM logs
+            WHERE id <= %s AND {filters}
+            GROUP BY ip_address, bucket
+        """, (COUNT_EPOCH, floor, *filter_params))
+        for row in cursor.fetchall():
+            counts.add(row["ip_address"], int(row["bucket"]), row["hits"])
+        counts.last_id = floor
+        counts.scanned = True
+
+    cursor.execute(f"""
+        SELECT id, ip_address,
+               TIMESTAMPDIFF(SECOND, %s, log_time) DIV {COUNT_BUCKET_SECONDS} AS bucket
+        FROM logs
+        WHERE id > %s AND id <= %s AND {filters}
+    """, (COUNT_EPOCH, counts.last_id, max_id, *filter_params))
+
+    seen = counts.seen
+    for row in cursor.fetchall():
+        if row["id"] not in seen:
+            seen.add(row["id"])
+            counts.add(row["ip_address"], int(row["bucket"]), 1)
+
+    if settled is not None and settled > counts.last_id:
+        counts.last_id = settled
+        counts.seen = {i for i in seen if i > settled}
+    counts.max_id = max_id
+    counts.expire(now)
+
+
+def window_counts(registry, name, key, window):
+    """The WindowCounts for name, reset if it was built from a different key."""
+    counts = registry.get(name)
+    if counts is None or counts.key != key:
+        counts = registry[name] = WindowCounts(key, window)
+    return counts
+
 # ================= GENERIC RULE EVALUATOR =================
 
-def evaluate_rule(rule):
+rule_counts = {}    # rule id -> WindowCounts
+
+
+def keep_rule_counts(rule_ids):
+    """Forget window counts for rules that are no longer evaluated."""
+    for rule_id in set(rule_counts) - set(rule_ids):
+        del rule_counts[rule_id]
+
+
+def evaluate_rule(rule, partitions=None, keep_alive=None):
     conn = get_connection()
     cursor = conn.cursor(dictionary=True)
 
-    time_limit = datetime.now() - timedelta(minutes=rule["time_window_minutes"])
-
     if rule["match_type"] == "equals":
-        condition = f"{rule['log_field']} = %s"
+        condition = f" AND {rule['log_field']} = %s"
+        value = rule["match_value"]
+    elif rule["match_type"] == "regex":
+        condition = f" AND {rule['log_field']} REGEXP %s"
         value = rule["match_value"]
     else:  # contains
-        condition = f"{rule['log_field']} LIKE %s"
+        condition = f" AND {rule['log_field']} LIKE %s"
         value = f"%{rule['match_value']}%"
 
-    query = f"""
-        SELECT ip_address, COUNT(*) as hit_count
-        FROM logs
-        WHERE {condition} AND log_time >= %s
-        GROUP BY ip_address
-        HAVING hit_count >= %s
-    """
+    key = (
+        rule["log_field"], rule["match_type"], rule["match_value"], rule["time_window_minutes"],
+        None if partitions is None else tuple(sorted(partitions)),
+    )
+    counts = window_counts(rule_counts, rule["id"], key, timedelta(minutes=rule["time_window_minutes"]))
+    scan_window(cursor, counts, condition, (value,), partitions)
 
-    cursor.execute(query, (value, time_limit, rule["threshold"]))
-    results = cursor.fetchall()
+    results = [
+        {"ip_address": ip, "hit_count": hits}
+        for ip, hits in counts.totals.items()
+        if hits >= rule["threshold"]
+    ]
 
     for result in results:
         # Create detailed alert for rule-based detection
@@ -146,121 +397,317 @@ Hit Count: {result['hit_count']}
 Detection Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
 Severity: {rule['severity']}"""
         
-        create_alert(cursor, rule["rule_name"], rule["severity"], details=details)
+        if keep_alive:
+            keep_alive()
+        create_alert(conn, cursor, rule["rule_name"], rule["severity"], details=details, ip=result["ip_address"])
 
     conn.commit()
     cursor.close()
     conn.close()
 
-# ================ ML- FEATURE  =================
+# ================= STREAMED RULES =================
+# Correlation and pattern rules are evaluated as a stream: every cycle reads
+# only the logs added since the last one (by id) and passes each row once
+# through the pattern matcher and the per-IP correlation state machines. The
+# id mark follows settled_log_id() like the window counts do, so rows that
+# commit out of id order are still processed, exactly once.
+
+STREAM_RULE_TYPES = ("correlation", "pattern")
+STREAM_FETCH_SIZE = 5000
+
+correlation = CorrelationEngine()
+patterns = PatternMatcher()
+pattern_hits = PatternHitCounter()
+stream_last_log_id = None
+stream_seen_ids = set()     # ids above stream_last_log_id already processed
+
+
+def is_stream_rule(rule):
+    return rule.get("rule_type") in STREAM_RULE_TYPES
+
+
+def evaluate_stream_rules(rules, partitions=None, keep_alive=None):
+    global stream_last_log_id, stream_seen_ids
+
+    correlation.set_rules([r for r in rules if r.get("rule_type") == "correlation"])
+    if patterns.set_rules([r for r in rules if r.get("rule_type") == "pattern"]):
+        pattern_hits.keep_rules(set(patterns.rules))
+    if not correlation.rules and not patterns.rules:
+        return
 
-def calculate_current_rates(window_minutes=5):
     conn = get_connection()
     cursor = conn.cursor(dictionary=True)
 
-    time_limit = datetime.now() - timedelta(minutes=window_minutes)
+    if stream_last_log_id is None:
+        # First run: replay the longest window so sequences and counts
+        # already in progress are not missed
+        longest = max(
+            [window for _rule, _steps, window in correlation.rules.values()]
+            + [timedelta(minutes=r["time_window_minutes"]) for r in patterns.rules.values()]
+        )
+        cursor.execute("SELECT MIN(id) AS first_id FROM logs WHERE log_time >= %s", (datetime.now() - longest,))
+        first_id = cursor.fetchone()["first_id"]
+        if first_id is None:
+            cursor.execute("SELECT COALESCE(MAX(id), 0) AS last_id FROM logs")
+            stream_last_log_id = cursor.fetchone()["last_id"]
+        else:
+            stream_last_log_id = first_id - 1
+
+    cursor.execute("SELECT COALESCE(MAX(id), 0) AS max_id FROM log_events")
+    max_id = cursor.fetchone()["max_id"]
+    settled = settled_log_id(max_id)
+
+    partition_sql, partition_params = partition_filter(partitions)
 
-    query = """
-        SELECT ip_address, COUNT(*) / %s AS rate
+    cursor.execute(f"""
+        SELECT id, log_time, source, level, ip_address, message
         FROM logs
-        WHERE log_time >= %s
-        GROUP BY ip_address
-    """
+        WHERE id > %s AND id <= %s AND ip_bin IS NOT NULL{partition_sql}
+        ORDER BY id
+    """, (stream_last_log_id, max_id, *partition_params))
+
+    # The result set is read unbuffered, so collect detections and raise
+    # their alerts once it has been consumed
+    completed = []
+    pattern_fired = []
+    while True:
+        rows = cursor.fetchmany(STREAM_FETCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            if row["id"] in stream_seen_ids:
+                continue
+            stream_seen_ids.add(row["id"])
+            for rule_id in patterns.match(row):
+                rule = patterns.rules[rule_id]
+                hit_count = pattern_hits.add(rule, row["ip_address"], row["log_time"])
+                if hit_count is not None:
+                    pattern_fired.append((rule, row["ip_address"], hit_count))
+            for rule, steps, entry in correlation.process(row):
+                completed.append((rule, steps, entry, row["ip_address"]))
+
+    if settled is not None and settled > stream_last_log_id:
+        stream_last_log_id = settled
+        stream_seen_ids = {i for i in stream_seen_ids if i > settled}
+
+    correlation.expire(datetime.now())
+
+    for rule, ip, hit_count in pattern_fired:
+        details = f"""Detection Type: Pattern Match
+Rule Name: {rule['rule_name']}
+Log Field: {rule['log_field']}
+Match Type: {rule['match_type']}
+Match Value: {rule['match_value']}
+Threshold: {rule['threshold']} occurrences
+Time Window: {rule['time_window_minutes']} minutes
+IP Address: {ip}
+Hit Count: {hit_count}
+Detection Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+Severity: {rule['severity']}"""
 
-    cursor.execute(query, (window_minutes, time_limit))
-    results = cursor.fetchall()
+        if keep_alive:
+            keep_alive()
+        create_alert(conn, cursor, rule["rule_name"], rule["severity"], details=details, ip=ip)
+
+    for rule, steps, entry, ip in completed:
+        details = f"""Detection Type: Correlation (Sequence)
+Rule Name: {rule['rule_name']}
+Sequence: {describe_steps(steps)}
+Time Window: {rule['time_window_minutes']} minutes
+IP Address: {ip}
+First Event: {entry[2]}
+Last Event: {entry[3]}
+Detection Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+Severity: {rule['severity']}"""
+
+        if keep_alive:
+            keep_alive()
+        create_alert(conn, cursor, rule["rule_name"], rule["severity"], details=details, ip=ip)
+
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+# ================ ML- FEATURE  =================
+
+rate_counts = {}    # window_minutes -> WindowCounts
+
+
+def calculate_current_rates(window_minutes=5, partitions=None):
+    conn = get_connection()
+    cursor = conn.cursor(dictionary=True)
+
+    key = None if partitions is None else tuple(sorted(partitions))
+    counts = window_counts(rate_counts, window_minutes, key, timedelta(minutes=window_minutes))
+    scan_window(cursor, counts, partitions=partitions)
+
+    results = [
+        {"ip_address": ip, "rate": hits / window_minutes}
+        for ip, hits in counts.totals.items()
+        if ip is not None   # ip_baselines.ip_address is NOT NULL
+    ]
 
     cursor.close()
     conn.close()
     return results
 
-#================ Update Baselines ================
+#================ Baseline State ================
+# Each IP keeps an exponentially weighted mean and variance of its event
+# rate (events/min) plus the number of cycles it has been observed. All IPs
+# are scored and updated as NumPy arrays in one pass.
+
+EWMA_ALPHA = 0.3            # weight of the newest rate in the moving average
+BASELINE_CHUNK_SIZE = 5000  # IPs per SELECT when loading baselines
+
+
+def rate_arrays(rates):
+    ips = [row["ip_address"] for row in rates]
+    current = np.fromiter((float(row["rate"]) for row in rates), dtype=np.float64, count=len(rates))
+    return ips, current
+
+
+def load_baselines(cursor, ips):
+    """Return (mean, var, samples) arrays aligned with ips; unseen IPs get zeros."""
+    found = {}
+
+    for start in range(0, len(ips), BASELINE_CHUNK_SIZE):
+        chunk = ips[start:start + BASELINE_CHUNK_SIZE]
+        placeholders = ", ".join(["%s"] * len(chunk))
+        cursor.execute(f"""
+            SELECT ip_address, avg_events_per_min, var_events_per_min, sample_count
+            FROM ip_baselines WHERE ip_address IN ({placeholders})
+        """, chunk)
+        for ip, avg, var, samples in cursor.fetchall():
+            found[ip] = (avg or 0.0, var or 0.0, samples or 0)
+
+    state = np.array([found.get(ip, (0.0, 0.0, 0)) for ip in ips], dtype=np.float64).reshape(-1, 3)
+    return state[:, 0], state[:, 1], state[:, 2].astype(np.int64)
+
+
+def ewma_update(current, mean, var, samples):
+    """Incremental EWMA / EWMVar step; the first observation seeds the mean."""
+    seen = samples > 0
+    diff = current - mean
+    incr = EWMA_ALPHA * diff
+    new_mean = np.where(seen, mean + incr, current)
+    new_var = np.where(seen, (1 - EWMA_ALPHA) * (var + diff * incr), 0.0)
+    return new_mean, new_var, samples + 1
+
+
 def update_baselines(rates):
+    if not rates:
+        return
+
     conn = get_connection()
     cursor = conn.cursor()
 
-    for row in rates:
-        ip = row["ip_address"]
-        rate = row["rate"]
+    ips, current = rate_arrays(rates)
+    mean, var, samples = load_baselines(cursor, ips)
 
-        cursor.execute(
-            "SELECT avg_events_per_min FROM ip_baselines WHERE ip_address=%s",
-            (ip,)
-        )
-        existing = cursor.fetchone()
-
-        if existing:
-            # Use exponential moving average (weight current rate more heavily)
-            new_avg = (float(existing[0]) * 0.3) + (float(rate) * 0.7)  # 70% weight to current rate
-            cursor.execute("""
-                UPDATE ip_baselines
-                SET avg_events_per_min=%s, last_updated=%s
-                WHERE ip_address=%s
-            """, (new_avg, datetime.now(), ip))
-        else:
-            cursor.execute("""
-                INSERT INTO ip_baselines (ip_address, avg_events_per_min, last_updated)
-                VALUES (%s, %s, %s)
-            """, (ip, rate, datetime.now()))
+    seen = samples > 0
+    new_mean, new_var, new_samples = ewma_update(current, mean, var, samples)
+
+    now = datetime.now()
+    cursor.executemany("""
+        INSERT INTO ip_baselines
+        (ip_address, avg_events_per_min, var_events_per_min, sample_count, last_updated)
+        VALUES (%s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            avg_events_per_min = VALUES(avg_events_per_min),
+            var_events_per_min = VALUES(var_events_per_min),
+            sample_count = VALUES(sample_count),
+            last_updated = VALUES(last_updated)
+    """, [
+        (ip, float(m), float(v), int(n), now)
+        for ip, m, v, n in zip(ips, new_mean, new_var, new_samples)
+    ])
+
+    new_ips = int((~seen).sum())
+    if new_ips:
+        print(f"[BASELINE] Initialized {new_ips} new IPs")
 
     conn.commit()
     cursor.close()
     conn.close()
 
 #================ Anomaly Detection =================
-ANOMALY_MULTIPLIER = 1.5  # Changed from 3 - triggers when rate > 1.5x baseline
+# An IP is anomalous when its current rate is ANOMALY_Z_THRESHOLD standard
+# deviations above its moving average *and* ANOMALY_MULTIPLIER times that
+# average. IPs need ANOMALY_MIN_SAMPLES cycles of history before they can
+# alert, and the standard deviation is floored at ANOMALY_MIN_STDDEV so quiet
+# IPs with almost no variance do not alert on a handful of extra events.
+
+ANOMALY_MULTIPLIER = 1.5
+ANOMALY_Z_THRESHOLD = 3.0
+ANOMALY_MIN_SAMPLES = 5
+ANOMALY_MIN_STDDEV = 1.0    # events/min
+ANOMALY_MIN_RATE = 1.0      # events/min
+
+
+def score_anomalies(current, mean, var, samples):
+    """Return (z_scores, anomalous_mask) for aligned rate/baseline arrays."""
+    std = np.sqrt(np.maximum(var, ANOMALY_MIN_STDDEV ** 2))
+    z = (current - mean) / std
+    anomalous = (
+        (samples >= ANOMALY_MIN_SAMPLES)
+        & (current >= ANOMALY_MIN_RATE)
+        & (z >= ANOMALY_Z_THRESHOLD)
+        & (current > mean * ANOMALY_MULTIPLIER)
+    )
+    return z, anomalous
 
 
-def detect_anomalies(rates):
+def detect_anomalies(rates, keep_alive=None):
+    if not rates:
+        return
+
     conn = get_connection()
     cursor = conn.cursor(dictionary=True)
 
-    for row in rates:
-        ip = row["ip_address"]
-        current_rate = row["rate"]
+    ips, current = rate_arrays(rates)
 
-        cursor.execute(
-            "SELECT avg_events_per_min FROM ip_baselines WHERE ip_address=%s",
-            (ip,)
-        )
-        base = cursor.fetchone()
-
-        if not base:
-            # Initialize baseline on first detection
-            cursor.execute("""
-                INSERT INTO ip_baselines (ip_address, avg_events_per_min, last_updated)
-                VALUES (%s, %s, %s)
-            """, (ip, current_rate, datetime.now()))
-            print(f"[BASELINE] Initialized for IP={ip} rate={float(current_rate):.2f}")
-            continue
-
-        baseline = base["avg_events_per_min"]
-
-        if baseline > 0 and float(current_rate) > float(baseline) * ANOMALY_MULTIPLIER:
-            print("\n" + "#"*70)
-            print(f"⚠️  ML ALERT - TRAFFIC SPIKE ANOMALY DETECTED")
-            print("#"*70)
-            print(f"IP Address:       {ip}")
-            print(f"Current Rate:     {float(current_rate):.2f} events/min")
-            print(f"Baseline Rate:    {float(baseline):.2f} events/min")
-            print(f"Multiplier:       {ANOMALY_MULTIPLIER}x")
-            print(f"Threshold:        {float(baseline) * ANOMALY_MULTIPLIER:.2f} events/min")
-            print(f"Detection Time:   {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-            print("#"*70 + "\n")
-            
-            # Create detailed alert for anomaly detection
-            details = f"""Detection Type: Anomaly Detection (ML)
+    raw_cursor = conn.cursor()
+    mean, var, samples = load_baselines(raw_cursor, ips)
+    raw_cursor.close()
+
+    z, anomalous = score_anomalies(current, mean, var, samples)
+    hits = np.flatnonzero(anomalous)
+
+    warming = int((samples < ANOMALY_MIN_SAMPLES).sum())
+    print(f"[ML] scored {len(ips)} IPs: {hits.size} anomalous, {warming} warming up")
+
+    for i in hits:
+        ip = ips[i]
+        current_rate = current[i]
+        baseline = mean[i]
+        stddev = np.sqrt(max(var[i], ANOMALY_MIN_STDDEV ** 2))
+
+        print("\n" + "#"*70)
+        print(f"⚠️  ML ALERT - TRAFFIC SPIKE ANOMALY DETECTED")
+        print("#"*70)
+        print(f"IP Address:       {ip}")
+        print(f"Current Rate:     {current_rate:.2f} events/min")
+        print(f"Baseline Rate:    {baseline:.2f} ± {stddev:.2f} events/min")
+        print(f"Z-Score:          {z[i]:.2f} (threshold {ANOMALY_Z_THRESHOLD})")
+        print(f"Detection Time:   {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        print("#"*70 + "\n")
+
+        # Create detailed alert for anomaly detection
+        details = f"""Detection Type: Anomaly Detection (ML)
 IP Address: {ip}
-Current Rate: {float(current_rate):.2f} events/min
-Baseline Rate: {float(baseline):.2f} events/min
+Current Rate: {current_rate:.2f} events/min
+Baseline Rate: {baseline:.2f} events/min
+Baseline Std Dev: {stddev:.2f} events/min
+Z-Score: {z[i]:.2f}
+Z-Score Threshold: {ANOMALY_Z_THRESHOLD}
 Anomaly Multiplier: {ANOMALY_MULTIPLIER}x
-Threshold: {float(baseline) * ANOMALY_MULTIPLIER:.2f} events/min
+Samples: {samples[i]}
 Detection Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
 Severity: MEDIUM"""
-            
-            create_alert(cursor, "Traffic Spike Anomaly Detected", "MEDIUM", details=details)
-        else:
-            print(f"[ML] IP={ip} rate={float(current_rate):.2f} baseline={float(baseline):.2f}")
+
+        if keep_alive:
+            keep_alive()
+        create_alert(conn, cursor, "Traffic Spike Anomaly Detected", "MEDIUM", details=details, ip=ip)
 
     conn.commit()
     cursor.close()
@@ -275,9 +722,13 @@ if __name__ == "__main__":
     while True:
      # Rule-based detection
         rules = load_rules()
+        keep_rule_counts([r["id"] for r in rules if not is_stream_rule(r)])
 
         for rule in rules:
-            evaluate_rule(rule)
+            if not is_stream_rule(rule):
+                evaluate_rule(rule)
+     # Pattern and multi-step correlation rules
+        evaluate_stream_rules(rules)
      # ML-style anomaly detection
         rates = calculate_current_rates()
         detect_anomalies(rates)
@@ -0,0 +1,220 @@
+from db import get_connection
+from detection_engine import (
+    NUM_PARTITIONS,
+    load_rules,
+    evaluate_rule,
+    keep_rule_counts,
+    evaluate_stream_rules,
+    is_stream_rule,
+    calculate_current_rates,
+    detect_anomalies,
+    update_baselines,
+)
+import multiprocessing
+import argparse
+import socket
+import time
+import os
+
+# Multi-process detection. A coordinator starts N workers; each worker owns a
+# slice of the NUM_PARTITIONS IP hash buckets and only evaluates rules and
+# baselines for IPs in those buckets. Ownership is a lease row in
+# detection_partitions, so two workers never process the same partition even
+# across hosts. Leases are renewed whenever half of LEASE_SECONDS has passed,
+# between rules and before each alert, so a slow cycle does not outlive them.
+#
+# A partition whose lease has been expired for ORPHAN_GRACE_SECONDS (its
+# worker died and nothing restarted it, e.g. the whole host went down) is
+# adopted by the live workers. Adopted partitions are marked as such; when
+# their assigned worker is back it sets `reclaim`, the adopter stops renewing
+# and drops them at its next renewal, and the assigned worker takes them over
+# once that lease has run out. Renewal happens well within LEASE_SECONDS, so
+# the adopter has let go before the partition changes hands.
+
+# ================= CONFIG =================
+
+CYCLE_SECONDS = 30          # same cadence as the single-process engine
+LEASE_SECONDS = 120         # must comfortably exceed one detection cycle
+MONITOR_INTERVAL = 5        # how often the coordinator checks its workers
+ORPHAN_GRACE_SECONDS = 60   # time a lapsed partition is left for its own worker
+
+
+def worker_name(pid=None):
+    return f"{socket.gethostname()}:{pid or os.getpid()}"
+
+
+def assigned_partitions(index, num_workers):
+    return list(range(index, NUM_PARTITIONS, num_workers))
+
+# ================= PARTITION LEASES =================
+
+def init_partitions():
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    # Starting with a lapsed lease lets the partitions be adopted if the
+    # worker they are assigned to never comes up
+    cursor.executemany(
+        "INSERT IGNORE INTO detection_partitions (partition_id, lease_expires) VALUES (%s, NOW())",
+        [(p,) for p in range(NUM_PARTITIONS)]
+    )
+
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+
+def acquire_partitions(owner, partitions):
+    """Claim or renew leases on partitions, adopt orphaned ones; return every partition held."""
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    placeholders = ", ".join(["%s"] * len(partitions))
+
+    # A single UPDATE is atomic, so a partition only changes hands when it is
+    # free, already ours, or its previous owner's lease has run out
+    cursor.execute(f"""
+        UPDATE detection_partitions
+        SET owner = %s, lease_expires = DATE_ADD(NOW(), INTERVAL %s SECOND), adopted = FALSE, reclaim = FALSE
+        WHERE partition_id IN ({placeholders})
+        AND (owner IS NULL OR owner = %s OR lease_expires < NOW())
+    """, (owner, LEASE_SECONDS, *partitions, owner))
+
+    # Ask whoever adopted our partitions to let them lapse
+    cursor.execute(f"""
+        UPDATE detection_partitions SET reclaim = TRUE
+        WHERE partition_id IN ({placeholders}) AND adopted AND owner <> %s
+    """, (*partitions, owner))
+
+    cursor.execute(f"""
+        UPDATE detection_partitions
+        SET owner = %s, lease_expires = DATE_ADD(NOW(), INTERVAL %s SECOND), adopted = TRUE, reclaim = FALSE
+        WHERE partition_id NOT IN ({placeholders})
+        AND ((owner = %s AND adopted AND NOT reclaim) OR lease_expires < DATE_SUB(NOW(), INTERVAL %s SECOND))
+    """, (owner, LEASE_SECONDS, *partitions, owner, ORPHAN_GRACE_SECONDS))
+    conn.commit()
+
+    cursor.execute(
+        "SELECT partition_id FROM detection_partitions WHERE owner = %s AND lease_expires > NOW() AND NOT reclaim",
+        (owner,)
+    )
+    owned = sorted(row[0] for row in cursor.fetchall())
+
+    cursor.close()
+    conn.close()
+
+    return owned
+
+
+def release_partitions(owner):
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    cursor.execute(
+        "UPDATE detection_partitions SET owner = NULL, lease_expires = NOW(), adopted = FALSE, reclaim = FALSE "
+        "WHERE owner = %s",
+        (owner,)
+    )
+
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+# ================= WORKER =================
+
+class PartitionLease:
+    """The partitions a worker holds, renewed once half the lease has run."""
+
+    def __init__(self, owner, partitions):
+        self.owner = owner
+        self.partitions = partitions    # assigned to this worker
+        self.owned = []                 # held right now, assigned or adopted
+        self.renewed_at = None
+
+    def renew(self, force=False):
+        now = time.monotonic()
+        if force or self.renewed_at is None or now - self.renewed_at >= LEASE_SECONDS / 2:
+            self.owned = acquire_partitions(self.owner, self.partitions)
+            self.renewed_at = now
+        return self.owned
+
+
+def run_worker(index, num_workers):
+    owner = worker_name()
+    partitions = assigned_partitions(index, num_workers)
+    lease = PartitionLease(owner, partitions)
+
+    print(f"[WORKER {index}] {owner} starting with partitions {partitions}")
+
+    try:
+        while True:
+            started = time.time()
+
+            owned = lease.renew(force=True)
+            waiting = sorted(set(partitions) - set(owned))
+            adopted = sorted(set(owned) - set(partitions))
+            if waiting:
+                print(f"[WORKER {index}] waiting for leases on {waiting}")
+            if adopted:
+                print(f"[WORKER {index}] covering orphaned partitions {adopted}")
+
+            if owned:
+                rules = load_rules()
+                keep_rule_counts([r["id"] for r in rules if not is_stream_rule(r)])
+                for rule in rules:
+                    if not is_stream_rule(rule) and lease.renew():
+                        evaluate_rule(rule, partitions=lease.owned, keep_alive=lease.renew)
+                if lease.renew():
+                    evaluate_stream_rules(rules, partitions=lease.owned, keep_alive=lease.renew)
+
+                rates = calculate_current_rates(partitions=lease.renew())
+                detect_anomalies(rates, keep_alive=lease.renew)
+                update_baselines(rates)
+
+            time.sleep(max(0, CYCLE_SECONDS - (time.time() - started)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        release_partitions(owner)
+
+# ================= COORDINATOR =================
+
+def run_coordinator(num_workers):
+    init_partitions()
+
+    workers = {}
+
+    print(f"Detection coordinator running with {num_workers} workers over {NUM_PARTITIONS} partitions...")
+
+    try:
+        while True:
+            for index in range(num_workers):
+                proc = workers.get(index)
+                if proc is not None and proc.is_alive():
+                    continue
+
+                if proc is not None:
+                    # Free the dead worker's leases so its replacement can
+                    # take over without waiting for them to expire
+                    print(f"[COORDINATOR] worker {index} (pid {proc.pid}) exited with {proc.exitcode}, restarting")
+                    release_partitions(worker_name(proc.pid))
+
+                proc = multiprocessing.Process(target=run_worker, args=(index, num_workers), daemon=True)
+                proc.start()
+                workers[index] = proc
+
+            time.sleep(MONITOR_INTERVAL)
+    except KeyboardInterrupt:
+        for proc in workers.values():
+            proc.join(timeout=10)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the detection engine as sharded worker processes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    if not 1 <= args.workers <= NUM_PARTITIONS:
+        parser.error(f"--workers must be between 1 and {NUM_PARTITIONS}")
+
+    run_coordinator(args.workers)
@@ -0,0 +1,186 @@
+from functools import lru_cache
+from array import array
+import threading
+import ipaddress
+import bisect
+import glob
+import time
+import csv
+import os
+
+# IP context (site, owner, ASN, reputation tag) from local CSV files.
+#
+# Every *.csv in ENRICHMENT_DIR needs a `cidr` column plus any of the
+# ENRICHMENT_FIELDS columns. Networks may nest (a /16 for the site, a /24
+# inside it for the owner); when they do, the more specific network's
+# non-empty values win. At load time the networks are flattened into
+# disjoint [start, end] ranges held in sorted arrays, so a lookup is one
+# bisect plus an LRU cache for repeat IPs. The files are re-read when one of
+# them changes, checked at most every ENRICHMENT_CHECK_SECONDS.
+
+ENRICHMENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "enrichment")
+ENRICHMENT_FIELDS = ("site", "owner", "asn", "reputation")
+ENRICHMENT_CHECK_SECONDS = 30
+ENRICHMENT_CACHE_SIZE = 65536
+MAX_FIELD_LENGTH = 100      # matches the ip_enrichments columns
+
+# ================= RANGE INDEX =================
+
+class RangeIndex:
+    """Disjoint, sorted IP ranges of one address family mapped to context tuples."""
+
+    def __init__(self, ranges, typecode=None):
+        """ranges: iterable of (start, end, context), sorted and non-overlapping."""
+        contexts = {}
+        self.starts = array(typecode) if typecode else []
+        self.ends = array(typecode) if typecode else []
+        self.slots = array("I")
+        self.contexts = []
+        for start, end, context in ranges:
+            slot = contexts.get(context)
+            if slot is None:
+                slot = contexts[context] = len(self.contexts)
+                self.contexts.append(context)
+            self.starts.append(start)
+            self.ends.append(end)
+            self.slots.append(slot)
+
+    def find(self, value):
+        i = bisect.bisect_right(self.starts, value) - 1
+        if i >= 0 and value <= self.ends[i]:
+            return self.contexts[self.slots[i]]
+        return None
+
+    def __len__(self):
+        return len(self.starts)
+
+
+def _merge(outer, inner):
+    return tuple(i if i else o for o, i in zip(outer, inner))
+
+
+def flatten_networks(networks):
+    """Turn (start, end, context) CIDR blocks, possibly nested, into disjoint ranges.
+
+    CIDR blocks either nest or do not overlap at all, so a stack of the
+    blocks enclosing the current position is enough: each piece of address
+    space gets the merged context of its innermost block.
+    """
+    out = []
+    stack = []      # (end, merged context) of the blocks enclosing `pos`
+    pos = 0
+
+    def emit_until(limit):
+        nonlocal pos
+        while stack and stack[-1][0] < limit:
+            end, context = stack.pop()
+            if pos <= end:
+                out.append((pos, end, context))
+                pos = end + 1
+        if stack and pos < limit:
+            out.append((pos, limit - 1, stack[-1][1]))
+            pos = limit
+
+    # Outer blocks first when two start at the same address
+    for start, end, context in sorted(networks, key=lambda n: (n[0], -n[1])):
+        emit_until(start)
+        stack.append((end, _merge(stack[-1][1], context) if stack else context))
+        pos = start
+
+    emit_until(float("inf"))
+    return out
+
+
+def load_index(paths):
+    """Build (IPv4 index, IPv6 index) from the given CSV files."""
+    networks = {4: [], 6: []}
+    skipped = 0
+
+    for path in paths:
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                try:
+                    network = ipaddress.ip_network((row.get("cidr") or "").strip(), strict=False)
+                except ValueError:
+                    skipped += 1
+                    continue
+                context = tuple(
+                    (row.get(field) or "").strip()[:MAX_FIELD_LENGTH] for field in ENRICHMENT_FIELDS
+                )
+                if not any(context):
+                    continue
+                networks[network.version].append(
+                    (int(network.network_address), int(network.broadcast_address), context)
+                )
+
+    if skipped:
+        print(f"[ENRICHMENT] Skipped {skipped} rows without a valid cidr")
+
+    # IPv4 fits in 32-bit array slots; IPv6 needs Python ints
+    return RangeIndex(flatten_networks(networks[4]), "I"), RangeIndex(flatten_networks(networks[6]))
+
+# ================= LOOKUPS =================
+
+_index = (RangeIndex([], "I"), RangeIndex([]))
+_index_files = None         # {path: mtime} the index was built from
+_next_check = 0.0
+_reload_lock = threading.Lock()
+
+
+def reload_if_changed(force=False):
+    """Rebuild the index if the CSV files were added, removed or modified."""
+    global _index, _index_files, _next_check
+
+    if not force and time.monotonic() < _next_check:
+        return
+    with _reload_lock:
+        if not force and time.monotonic() < _next_check:
+            return
+        _next_check = time.monotonic() + ENRICHMENT_CHECK_SECONDS
+
+        paths = sorted(glob.glob(os.path.join(ENRICHMENT_DIR, "*.csv")))
+        try:
+            files = {path: os.path.getmtime(path) for path in paths}
+        except OSError:
+            return      # a file is being replaced; try again on the next check
+        if files == _index_files:
+            return
+
+        try:
+            index = load_index(paths)
+        except (OSError, UnicodeDecodeError, csv.Error) as e:
+            print(f"[ENRICHMENT] Keeping the previous index, failed to load: {e}")
+            return
+
+        _index, _index_files = index, files
+        _lookup.cache_clear()
+        if paths:
+            print(f"[ENRICHMENT] Loaded {len(index[0]) + len(index[1])} ranges from {len(paths)} files")
+
+
+@lru_cache(maxsize=ENRICHMENT_CACHE_SIZE)
+def _lookup(ip):
+    try:
+        address = ipaddress.ip_address(ip.strip())
+    except ValueError:
+        return None
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    return _index[0 if address.version == 4 else 1].find(int(address))
+
+
+def ip_context(ip):
+    """(site, owner, asn, reputation) for an IP, or None if no dataset covers it."""
+    if ip is None:
+        return None
+    reload_if_changed()
+    return _lookup(str(ip))
+
+
+def describe_ip(ip):
+    """Context lines for alert details, or "" if the IP is unknown."""
+    context = ip_context(ip)
+    if context is None:
+        return ""
+    labels = ("Site", "Owner", "ASN", "Reputation")
+    return "\n".join(f"{label}: {value}" for label, value in zip(labels, context) if value)
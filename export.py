@@ -0,0 +1,124 @@
+from db import get_connection
+from datetime import datetime
+import json
+import zlib
+import csv
+import io
+
+# Streaming export shared by /api/export/logs and /api/export/alerts.
+#
+# Rows come from the default (unbuffered) cursor FETCH_SIZE at a time and are
+# encoded and yielded as they are read, so the web worker's memory stays the
+# same whether the export is a hundred rows or fifty million. The generator
+# owns its own connection and closes it when the response ends or the client
+# disconnects.
+#
+# The server writes rows only as fast as the HTTP client accepts them, so the
+# export session raises net_write_timeout / net_read_timeout (60s / 30s by
+# default) to EXPORT_NET_TIMEOUT; otherwise a client that stalls for a minute
+# gets a truncated file.
+
+EXPORT_FETCH_SIZE = 5000
+EXPORT_NET_TIMEOUT = 3600   # seconds a stalled client may hold the stream
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+}
+
+LOG_EXPORT_COLUMNS = (
+    "id", "log_time", "source", "level", "ip_address", "message",
+    "site", "owner", "asn", "reputation",
+)
+ALERT_EXPORT_COLUMNS = (
+    "id", "rule_name", "severity", "status", "created_time", "first_seen", "last_seen",
+    "hit_count", "ip_address", "message",
+)
+
+
+def export_options(args):
+    """Parse format, gzip and start/end from the query string; raises ValueError."""
+    fmt = args.get("format", "csv").lower()
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(EXPORT_FORMATS)}")
+
+    compress = args.get("gzip", "").lower() in ("1", "true", "yes")
+
+    times = []
+    for name in ("start", "end"):
+        value = args.get(name)
+        try:
+            times.append(datetime.fromisoformat(value) if value else None)
+        except ValueError:
+            raise ValueError(f"{name} must be an ISO date or datetime, e.g. 2026-10-01T00:00")
+
+    return fmt, compress, times[0], times[1]
+
+
+def export_filename(name, fmt, compress):
+    extension = EXPORT_FORMATS[fmt][1] + (".gz" if compress else "")
+    return f"{name}-{datetime.now():%Y%m%d-%H%M%S}.{extension}"
+
+
+def _encode_csv(columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def encode(rows):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        return buffer.getvalue().encode("utf-8")
+
+    return encode
+
+
+def _encode_ndjson(columns):
+    def encode(rows):
+        return "".join(
+            json.dumps(dict(zip(columns, row)), default=str) + "\n" for row in rows
+        ).encode("utf-8")
+
+    return encode
+
+
+def stream_export(query, params, columns, fmt="csv", compress=False):
+    """Yield the encoded result of `query` chunk by chunk (gzip-compressed if asked)."""
+    encode = _encode_csv(columns) if fmt == "csv" else _encode_ndjson(columns)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def emit(data):
+        return compressor.compress(data) if compressor else data
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "SET SESSION net_write_timeout = %s, net_read_timeout = %s",
+            (EXPORT_NET_TIMEOUT, EXPORT_NET_TIMEOUT)
+        )
+        cursor.execute(query, params)
+
+        if fmt == "csv":
+            chunk = emit(encode([columns]))
+            if chunk:
+                yield chunk
+
+        while True:
+            rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            chunk = emit(encode(rows))
+            if chunk:
+                yield chunk
+
+        if compressor:
+            yield compressor.flush()
+    finally:
+        try:
+            cursor.close()
+        except Exception:
+            # Rows left unread because the client went away; closing the
+            # connection below discards them
+            pass
+        conn.close()
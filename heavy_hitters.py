@@ -0,0 +1,187 @@
+from datetime import datetime, timedelta
+import threading
+import ipaddress
+import time
+import re
+
+# Noisiest IPs, sources and messages without GROUP BY scans over logs.
+#
+# Ingest feeds each event into a Space-Saving summary per (minute bucket,
+# dimension) holding at most HITTER_CAPACITY items. An item outside the
+# summary replaces the current minimum and inherits its count as error.
+# Summaries are flushed as count deltas into heavy_hitters every
+# HITTER_FLUSH_SECONDS (after a write, or from ingest's background flusher
+# when traffic goes quiet, and once more at shutdown), so every ingest
+# process (web app, syslog receiver) contributes, and a top-K query only sums
+# a few hundred rows per minute of window.
+#
+# Within one flushed summary, an item with more than 1/HITTER_CAPACITY of its
+# traffic is always kept and overcounted by at most `error`. The summed rows
+# are less exact: an item evicted from some summary before that summary was
+# flushed is missing those hits, so a total can be low as well as high.
+# Items heavy enough to stay in every summary have a true count between
+# hits - max_error and hits; for the rest the numbers are estimates.
+
+HITTER_CAPACITY = 100
+HITTER_FLUSH_SECONDS = 10
+HITTER_BUCKET_MINUTES = 1
+HITTER_RETENTION_HOURS = 24
+MAX_ITEM_LENGTH = 255
+
+DIMENSIONS = ("ip", "source", "message")
+
+# ================= MESSAGE NORMALIZATION =================
+
+def _ipv6_or_text(match):
+    # The pattern also matches clock times like 12:30:45; keep those as text
+    try:
+        ipaddress.IPv6Address(match.group())
+    except ValueError:
+        return match.group()
+    return "<ip>"
+
+
+_NORMALIZERS = [
+    (re.compile(r"\b\d{1,3}(?:\.\d{1,3}){3}\b"), "<ip>"),
+    (re.compile(r"(?<![\w:])[0-9a-fA-F]{0,4}(?::[0-9a-fA-F]{0,4}){2,7}(?![\w:])"), _ipv6_or_text),
+    (re.compile(r"\b0x[0-9a-fA-F]+\b"), "<hex>"),
+    (re.compile(r"\b[0-9a-fA-F]{16,}\b"), "<hex>"),
+    (re.compile(r"\b\d+\b"), "<num>"),
+    (re.compile(r"\s+"), " "),
+]
+
+
+def normalize_message(message):
+    """Collapse variable parts (IPs, numbers, hex ids) so similar messages group together."""
+    text = str(message)
+    for pattern, replacement in _NORMALIZERS:
+        text = pattern.sub(replacement, text)
+    return text.strip()[:MAX_ITEM_LENGTH]
+
+# ================= SPACE-SAVING =================
+
+class SpaceSaving:
+    def __init__(self, capacity=HITTER_CAPACITY):
+        self.capacity = capacity
+        self.counts = {}    # item -> [count, error]
+
+    def add(self, item, weight=1):
+        entry = self.counts.get(item)
+        if entry is not None:
+            entry[0] += weight
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = [weight, 0]
+        else:
+            victim = min(self.counts, key=lambda k: self.counts[k][0])
+            floor = self.counts.pop(victim)[0]
+            self.counts[item] = [floor + weight, floor]
+
+    def top(self, k):
+        return sorted(self.counts.items(), key=lambda kv: kv[1][0], reverse=True)[:k]
+
+# ================= INGEST BUFFER =================
+
+_buffer = {}    # (bucket_start, dimension) -> SpaceSaving
+_buffer_lock = threading.Lock()
+_last_flush = time.monotonic()
+_last_prune = 0.0
+
+
+def _bucket(ts):
+    if not isinstance(ts, datetime):
+        try:
+            ts = datetime.fromisoformat(str(ts))
+        except ValueError:
+            ts = datetime.now()
+    if ts.tzinfo is not None:
+        ts = ts.astimezone().replace(tzinfo=None)
+    return ts.replace(minute=ts.minute - ts.minute % HITTER_BUCKET_MINUTES, second=0, microsecond=0)
+
+
+def track_events(records):
+    """Count the IP, source and normalized message of each ingested record."""
+    with _buffer_lock:
+        for record in records:
+            bucket = _bucket(record["timestamp"])
+            for dimension, value in (
+                ("ip", record["ip"]),
+                ("source", record["source"]),
+                ("message", normalize_message(record["message"]) if record["message"] is not None else None),
+            ):
+                if value is None:
+                    continue
+                summary = _buffer.get((bucket, dimension))
+                if summary is None:
+                    summary = _buffer[(bucket, dimension)] = SpaceSaving()
+                summary.add(str(value)[:MAX_ITEM_LENGTH])
+
+
+def has_pending():
+    return bool(_buffer)
+
+
+def flush_heavy_hitters(conn, force=False):
+    """Add buffered counts to the heavy_hitters table if HITTER_FLUSH_SECONDS have passed."""
+    global _buffer, _last_flush, _last_prune
+
+    with _buffer_lock:
+        if not _buffer or (not force and time.monotonic() - _last_flush < HITTER_FLUSH_SECONDS):
+            return
+        pending, _buffer = _buffer, {}
+        _last_flush = time.monotonic()
+
+    rows = [
+        (bucket, dimension, item, count, error)
+        for (bucket, dimension), summary in sorted(pending.items())
+        for item, (count, error) in summary.counts.items()
+    ]
+
+    cursor = conn.cursor()
+    try:
+        cursor.executemany("""
+            INSERT INTO heavy_hitters (bucket_start, dimension, item, hits, error)
+            VALUES (%s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE hits = hits + VALUES(hits), error = error + VALUES(error)
+        """, rows)
+
+        if time.monotonic() - _last_prune > 3600:
+            cursor.execute(
+                "DELETE FROM heavy_hitters WHERE bucket_start < %s",
+                (datetime.now() - timedelta(hours=HITTER_RETENTION_HOURS),)
+            )
+            _last_prune = time.monotonic()
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        # Put the counts back so they are retried on the next flush
+        with _buffer_lock:
+            for key, summary in pending.items():
+                current = _buffer.setdefault(key, SpaceSaving())
+                for item, (count, _error) in summary.counts.items():
+                    current.add(item, count)
+        raise
+    finally:
+        cursor.close()
+
+# ================= QUERIES =================
+
+def top_items(conn, dimension, minutes=15, limit=20):
+    """Top `limit` items for a dimension over the last `minutes`, with the summed overcount bound."""
+    cursor = conn.cursor(dictionary=True)
+
+    cursor.execute("""
+        SELECT item, SUM(hits) AS hits, SUM(error) AS max_error
+        FROM heavy_hitters
+        WHERE dimension = %s AND bucket_start >= %s
+        GROUP BY item
+        ORDER BY hits DESC
+        LIMIT %s
+    """, (dimension, _bucket(datetime.now() - timedelta(minutes=minutes)), limit))
+    rows = cursor.fetchall()
+
+    cursor.close()
+    return [
+        {"item": row["item"], "hits": int(row["hits"]), "max_error": int(row["max_error"])}
+        for row in rows
+    ]
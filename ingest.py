@@ -0,0 +1,506 @@
+from db import get_connection
+from ip_sketches import add_events, flush_sketches
+from heavy_hitters import track_events, flush_heavy_hitters
+from spool import Spool, SpoolFull, start_replayer
+from enrichment import ip_context
+from heavy_hitters import has_pending as hitters_pending
+from ip_sketches import has_pending as sketches_pending
+from datetime import datetime
+from functools import lru_cache
+import mysql.connector
+import atexit
+import ipaddress
+import threading
+import time
+import gzip
+import json
+
+try:
+    import msgpack
+except ImportError:  # MessagePack ingest is optional
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # zstd bodies are optional
+    zstandard = None
+
+# Shared write path for everything that stores events (the /api/logs
+# endpoint and the syslog receiver). Rows go to log_events with the source
+# interned into log_sources and the IP packed to 4/16 bytes; the logs view
+# decodes them again for readers.
+
+LOG_INSERT_QUERY = """
+    INSERT INTO log_events (source_id, level, message, ip, log_time, enrichment_id)
+    VALUES (%s, %s, %s, %s, %s, %s)
+"""
+
+REQUIRED_FIELDS = ["source", "level", "message", "ip", "timestamp"]
+
+INGEST_BATCH_SIZE = 1000   # rows per INSERT when a request carries many events
+READ_CHUNK_SIZE = 65536    # bytes read from the (decompressed) body at a time
+MAX_LINE_SIZE = 1048576    # longest NDJSON line accepted
+MAX_JSON_SIZE = 16777216   # largest JSON body accepted once decompressed
+MAX_BODY_SIZE = 67108864   # largest request body on the wire (Flask MAX_CONTENT_LENGTH)
+
+JSON_TYPES = {"application/json"}
+NDJSON_TYPES = {"application/x-ndjson", "application/ndjson", "application/jsonl"}
+MSGPACK_TYPES = {"application/msgpack", "application/x-msgpack", "application/vnd.msgpack"}
+
+# First byte of a MessagePack array (fixarray, array 16, array 32)
+MSGPACK_ARRAY_BYTES = set(range(0x90, 0xa0)) | {0xdc, 0xdd}
+
+
+LOG_LEVELS = {"INFO", "WARNING", "ERROR", "CRITICAL"}   # log_events.level ENUM
+MAX_MESSAGE_BYTES = 65535                              # log_events.message TEXT
+SCALAR_TYPES = (str, int, float)
+
+
+def parse_timestamp(value):
+    """A record's timestamp as a datetime (ISO string or datetime), or None if invalid."""
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value.strip())
+        except ValueError:
+            return None
+    return None
+
+
+def is_valid_record(record):
+    """Check that a record has every field with a value the log_events columns accept.
+
+    One bad row fails the whole multi-row INSERT, so records are checked
+    here and rejected individually instead.
+    """
+    if not isinstance(record, dict) or not all(field in record for field in REQUIRED_FIELDS):
+        return False
+    if not isinstance(record["level"], str) or record["level"].upper() not in LOG_LEVELS:
+        return False
+    if parse_timestamp(record["timestamp"]) is None:
+        return False
+    if not all(record[field] is None or isinstance(record[field], SCALAR_TYPES) for field in ("source", "ip")):
+        return False
+    message = record["message"]
+    if message is not None and not isinstance(message, SCALAR_TYPES):
+        return False
+    return len(str(message).encode("utf-8")) <= MAX_MESSAGE_BYTES
+
+
+# ================= VALUE ENCODING =================
+
+SOURCE_CACHE_MAX_SIZE = 10000
+MAX_SOURCE_LENGTH = 255     # log_sources.name VARCHAR(255)
+
+# source name -> log_sources.id; ids never change once committed, so the cache
+# only needs a size bound. Other threads may clear it at any time, so a batch
+# works from the dict intern_sources() returns, never from the cache itself.
+_source_ids = {}
+
+
+@lru_cache(maxsize=65536)
+def pack_ip(ip):
+    """Binary form of an IP address as stored in log_events.ip (None if unparseable)."""
+    try:
+        return ipaddress.ip_address(str(ip).strip()).packed
+    except ValueError:
+        return None
+
+
+def source_name(source):
+    """A source as stored in log_sources.name: cut to the column length, without the
+    trailing spaces the PAD SPACE collation ignores (so the name lookup finds it)."""
+    if source is None:
+        return None
+    return str(source)[:MAX_SOURCE_LENGTH].rstrip()
+
+
+def intern_sources(conn, cursor, names):
+    """Return {name: log_sources id} for the given names, in one round trip for cache misses."""
+    ids, missing = {}, []
+    for name in names:
+        source_id = _source_ids.get(name)
+        if source_id is None:
+            missing.append(name)
+        else:
+            ids[name] = source_id
+    if not missing:
+        return ids
+
+    if len(_source_ids) + len(missing) > SOURCE_CACHE_MAX_SIZE:
+        _source_ids.clear()
+
+    cursor.executemany("INSERT IGNORE INTO log_sources (name) VALUES (%s)", [(name,) for name in missing])
+
+    placeholders = ", ".join(["%s"] * len(missing))
+    cursor.execute(f"SELECT id, name FROM log_sources WHERE name IN ({placeholders})", missing)
+    rows = cursor.fetchall()
+
+    # Commit before caching so cached ids never point at a rolled-back row
+    conn.commit()
+    for source_id, name in rows:
+        ids[name] = _source_ids[name] = source_id
+    return ids
+
+
+# (site, owner, asn, reputation) -> ip_enrichments.id, same rules as _source_ids
+_enrichment_ids = {}
+
+
+def intern_enrichments(conn, cursor, contexts):
+    """Return {context: ip_enrichments id} for the given IP context tuples."""
+    ids, missing = {}, []
+    for context in contexts:
+        if context is None:
+            continue
+        enrichment_id = _enrichment_ids.get(context)
+        if enrichment_id is None:
+            missing.append(context)
+        else:
+            ids[context] = enrichment_id
+    if not missing:
+        return ids
+
+    if len(_enrichment_ids) + len(missing) > SOURCE_CACHE_MAX_SIZE:
+        _enrichment_ids.clear()
+
+    cursor.executemany(
+        "INSERT IGNORE INTO ip_enrichments (site, owner, asn, reputation) VALUES (%s, %s, %s, %s)",
+        missing
+    )
+
+    condition = " OR ".join(["(site = %s AND owner = %s AND asn = %s AND reputation = %s)"] * len(missing))
+    cursor.execute(
+        f"SELECT id, site, owner, asn, reputation FROM ip_enrichments WHERE {condition}",
+        [value for context in missing for value in context]
+    )
+    rows = cursor.fetchall()
+
+    conn.commit()
+    for enrichment_id, *context in rows:
+        ids[tuple(context)] = _enrichment_ids[tuple(context)] = enrichment_id
+    return ids
+
+
+def record_values(record, source_ids, enrichment_id=None):
+    timestamp = parse_timestamp(record["timestamp"])
+    if timestamp is not None and timestamp.tzinfo is not None:
+        # log_time is stored as local time without a zone
+        timestamp = timestamp.astimezone().replace(tzinfo=None)
+
+    return (
+        source_ids.get(source_name(record["source"])),
+        record["level"],
+        record["message"],
+        pack_ip(record["ip"]),
+        timestamp,
+        enrichment_id
+    )
+
+
+def write_logs(records):
+    """Insert a batch of log records in a single round trip and return how many were written."""
+    if not records:
+        return 0
+
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    try:
+        source_ids = intern_sources(conn, cursor, {source_name(r["source"]) for r in records} - {None})
+        contexts = [ip_context(r["ip"]) for r in records]
+        enrichment_ids = intern_enrichments(conn, cursor, set(contexts))
+        values = [record_values(r, source_ids, enrichment_ids.get(c)) for r, c in zip(records, contexts)]
+        cursor.executemany(LOG_INSERT_QUERY, values)
+        conn.commit()
+
+        add_events((v[0], v[3], v[4]) for v in values)
+        track_events(records)
+        try:
+            flush_sketches(conn)
+            flush_heavy_hitters(conn)
+        except Exception as e:
+            # Updates stay buffered and are retried on the next batch
+            print(f"Failed to flush ingest summaries: {e}")
+    finally:
+        cursor.close()
+        conn.close()
+
+    return len(records)
+
+# ================= SUMMARY FLUSHING =================
+# write_logs() only flushes the summaries when a batch arrives, so a
+# background thread flushes whatever is still buffered once traffic stops,
+# and an exit hook writes the rest on shutdown.
+
+SUMMARY_FLUSH_INTERVAL = 5
+
+_flusher_lock = threading.Lock()
+_flusher = None
+
+
+def flush_summaries(force=False):
+    """Flush buffered sketches and heavy-hitter counts that are due (all of them if force)."""
+    if not sketches_pending() and not hitters_pending():
+        return
+    conn = get_connection()
+    try:
+        flush_sketches(conn, force)
+        flush_heavy_hitters(conn, force)
+    finally:
+        conn.close()
+
+
+def _flush_at_exit():
+    try:
+        flush_summaries(force=True)
+    except Exception as e:
+        print(f"Failed to flush ingest summaries at exit: {e}")
+
+
+def start_summary_flusher():
+    """Start the background summary flush thread (once per process)."""
+    global _flusher
+
+    def run():
+        while True:
+            time.sleep(SUMMARY_FLUSH_INTERVAL)
+            try:
+                flush_summaries()
+            except Exception as e:
+                print(f"Failed to flush ingest summaries: {e}")
+
+    with _flusher_lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=run, name="summary-flusher", daemon=True)
+            _flusher.start()
+            atexit.register(_flush_at_exit)
+
+# ================= SPOOL FALLBACK =================
+# When the database is down or slow, batches go to the on-disk spool (see
+# spool.py) instead of failing, and a background thread replays them once
+# the database accepts writes again. After a failure, or a write slower than
+# SLOW_WRITE_SECONDS, batches skip the database for SPOOL_RETRY_SECONDS so
+# callers do not each wait on a connect timeout.
+
+SPOOL_RETRY_SECONDS = 5
+SLOW_WRITE_SECONDS = 2.0
+
+# Errors that mean "the database cannot take writes right now" (connection
+# refused or lost, server shutting down, too many connections, ...), as
+# opposed to a batch the database rejects
+DB_UNAVAILABLE_ERRORS = (mysql.connector.errors.InterfaceError, mysql.connector.errors.OperationalError)
+
+spool = Spool()
+_bypass_db_until = 0.0
+_replayer_lock = threading.Lock()
+_replayer = None
+
+
+def is_db_unavailable(error):
+    return isinstance(error, DB_UNAVAILABLE_ERRORS)
+
+
+def start_spool_replayer():
+    """Start the background thread that drains the spool into the database (once per process)."""
+    global _replayer
+    with _replayer_lock:
+        if _replayer is None:
+            _replayer = start_replayer(spool, write_logs, is_db_unavailable)
+
+
+def write_each(records):
+    """Write records one at a time, dropping those the database rejects; return how many were written."""
+    written = 0
+    for record in records:
+        try:
+            written += write_logs([record])
+        except DB_UNAVAILABLE_ERRORS:
+            raise
+        except mysql.connector.Error as e:
+            print(f"Dropped a log record the database rejected: {e}")
+    return written
+
+
+def save_logs(records):
+    """Write a batch to the database, or to the spool if the database is unavailable or behind.
+
+    Returns the number of records stored; rows the database rejects are
+    dropped. Raises SpoolFull if the database is unavailable and the spool is
+    at its size cap.
+    """
+    global _bypass_db_until
+
+    if not records:
+        return 0
+
+    if time.monotonic() >= _bypass_db_until:
+        started = time.monotonic()
+        try:
+            written = write_logs(records)
+        except DB_UNAVAILABLE_ERRORS as e:
+            print(f"[SPOOL] Database unavailable, spooling for {SPOOL_RETRY_SECONDS}s: {e}")
+            _bypass_db_until = time.monotonic() + SPOOL_RETRY_SECONDS
+        except mysql.connector.Error as e:
+            print(f"Database rejected a batch of {len(records)} logs, writing them one by one: {e}")
+            return write_each(records)
+        else:
+            if time.monotonic() - started > SLOW_WRITE_SECONDS:
+                print(f"[SPOOL] Database write took {time.monotonic() - started:.1f}s, spooling for {SPOOL_RETRY_SECONDS}s")
+                _bypass_db_until = time.monotonic() + SPOOL_RETRY_SECONDS
+            return written
+
+    spool.append(records)
+    return len(records)
+
+# ================= REQUEST BODY DECODING =================
+
+# Errors raised by a malformed or truncated body (bad JSON, corrupt gzip/zstd
+# stream, invalid MessagePack)
+DECODE_ERRORS = (ValueError, OSError, EOFError)
+if msgpack is not None:
+    # BufferFull (an object over MAX_LINE_SIZE) and OutOfData are not ValueErrors
+    DECODE_ERRORS += (msgpack.exceptions.UnpackException,)
+if zstandard is not None:
+    DECODE_ERRORS += (zstandard.ZstdError,)
+
+class BodyTooLarge(Exception):
+    pass
+
+
+def unsupported_format(mimetype, content_encoding):
+    """Return an error message if the body cannot be decoded here, else None."""
+    encoding = (content_encoding or "identity").lower()
+    if encoding not in ("identity", "gzip", "x-gzip", "zstd"):
+        return f"Unsupported Content-Encoding: {encoding}"
+    if encoding == "zstd" and zstandard is None:
+        return "zstd bodies require the zstandard package"
+
+    mimetype = (mimetype or "application/json").lower()
+    if mimetype in MSGPACK_TYPES:
+        if msgpack is None:
+            return "MessagePack bodies require the msgpack package"
+    elif mimetype not in JSON_TYPES and mimetype not in NDJSON_TYPES:
+        return f"Unsupported Content-Type: {mimetype}"
+
+    return None
+
+
+def _decompressed(stream, content_encoding):
+    encoding = (content_encoding or "identity").lower()
+    if encoding in ("gzip", "x-gzip"):
+        return gzip.GzipFile(fileobj=stream, mode="rb")
+    if encoding == "zstd":
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+    return stream
+
+
+def _iter_chunks(fp):
+    while True:
+        chunk = fp.read(READ_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _iter_ndjson(fp):
+    buffer = b""
+    for chunk in _iter_chunks(fp):
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        if len(buffer) > MAX_LINE_SIZE:
+            raise ValueError("NDJSON line too long")
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    if buffer.strip():
+        yield json.loads(buffer)
+
+
+def _iter_msgpack(fp):
+    chunks = _iter_chunks(fp)
+    unpacker = msgpack.Unpacker(raw=False, timestamp=3, max_buffer_size=MAX_LINE_SIZE)
+
+    # Buffer enough bytes to hold a complete array header (at most 5 bytes)
+    head = b""
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= 5:
+            break
+    if not head:
+        return
+    unpacker.feed(head)
+
+    # A top-level array is a batch; unpack it element by element instead of
+    # materializing the whole list
+    if head[0] in MSGPACK_ARRAY_BYTES:
+        unpacker.read_array_header()
+
+    yield from unpacker
+    for chunk in chunks:
+        unpacker.feed(chunk)
+        yield from unpacker
+
+
+def _read_capped(fp, limit):
+    """Read fp to the end, raising BodyTooLarge past limit bytes (a small
+    gzip/zstd body can inflate to gigabytes)."""
+    chunks, size = [], 0
+    for chunk in _iter_chunks(fp):
+        size += len(chunk)
+        if size > limit:
+            raise BodyTooLarge(f"JSON body is over {limit} bytes; send large batches as NDJSON or MessagePack")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def iter_records(stream, mimetype, content_encoding):
+    """Yield events from a request body without inflating it fully in memory.
+
+    JSON bodies (a single object or an array) are parsed in one go and capped
+    at MAX_JSON_SIZE decompressed; use NDJSON or MessagePack for large
+    batches so they are decoded incrementally. Raises BodyTooLarge.
+    """
+    fp = _decompressed(stream, content_encoding)
+    mimetype = (mimetype or "application/json").lower()
+
+    if mimetype in NDJSON_TYPES:
+        yield from _iter_ndjson(fp)
+    elif mimetype in MSGPACK_TYPES:
+        yield from _iter_msgpack(fp)
+    else:
+        data = json.loads(_read_capped(fp, MAX_JSON_SIZE))
+        if isinstance(data, list):
+            yield from data
+        else:
+            yield data
+
+
+def ingest_records(records, counts):
+    """Save valid records in batches, tallying "accepted"/"rejected" in counts.
+
+    Records that fail is_valid_record() or that the database rejects count
+    as rejected.
+
+    counts is updated as batches are saved, so it stays accurate if decoding
+    fails part way through the body or the spool fills up.
+    """
+    batch = []
+
+    for record in records:
+        if not is_valid_record(record):
+            counts["rejected"] += 1
+            continue
+        batch.append(record)
+        if len(batch) >= INGEST_BATCH_SIZE:
+            _save_batch(batch, counts)
+            batch = []
+
+    _save_batch(batch, counts)
+
+
+def _save_batch(batch, counts):
+    saved = save_logs(batch)
+    counts["accepted"] += saved
+    counts["rejected"] += len(batch) - saved
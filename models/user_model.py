@@ -1,5 +1,8 @@
 from db import get_connection
 from flask_login import UserMixin
+from collections import OrderedDict
+import threading
+import time
 
 
 class User(UserMixin):
@@ -21,6 +24,63 @@ class User(UserMixin):
     #     return str(self.id)
 
 
+# ================= USER CACHE =================
+
+# Flask-Login calls load_user on every authenticated request, so keep recently
+# loaded users in memory. Entries expire after USER_CACHE_TTL seconds so that
+# changes made from another process (or directly in MySQL) still show up.
+USER_CACHE_TTL = 60
+USER_CACHE_MAX_SIZE = 1024
+
+_user_cache = OrderedDict()  # str(user_id) -> (expires_at, User)
+_user_cache_lock = threading.Lock()
+
+
+def _cache_get(user_id):
+    key = str(user_id)
+    with _user_cache_lock:
+        entry = _user_cache.get(key)
+        if entry is None:
+            return None
+        expires_at, user = entry
+        if expires_at < time.monotonic():
+            del _user_cache[key]
+            return None
+        _user_cache.move_to_end(key)
+        return user
+
+
+def _cache_put(user):
+    key = str(user.id)
+    with _user_cache_lock:
+        _user_cache[key] = (time.monotonic() + USER_CACHE_TTL, user)
+        _user_cache.move_to_end(key)
+        while len(_user_cache) > USER_CACHE_MAX_SIZE:
+            _user_cache.popitem(last=False)
+
+
+def invalidate_user(user_id):
+    with _user_cache_lock:
+        _user_cache.pop(str(user_id), None)
+
+
+def clear_user_cache():
+    with _user_cache_lock:
+        _user_cache.clear()
+
+
+def _row_to_user(row):
+    return User(
+        row["id"],
+        row["username"],
+        row["password_hash"],
+        row.get("role"),
+        row.get("is_active", 1),
+        row.get("created_at"),
+        row.get("last_login")
+    )
+
+
 def get_user_by_username(username):
     conn = get_connection()
     cursor = conn.cursor(dictionary=True)
@@ -32,19 +92,15 @@ def get_user_by_username(username):
     conn.close()
 
     if row:
-        return User(
-            row["id"],
-            row["username"],
-            row["password_hash"],
-            row.get("role"),
-            row.get("is_active", 1),
-            row.get("created_at"),
-            row.get("last_login")
-        )
+        return _row_to_user(row)
     return None
 
 
 def get_user_by_id(user_id):
+    user = _cache_get(user_id)
+    if user is not None:
+        return user
+
     conn = get_connection()
     cursor = conn.cursor(dictionary=True)
 
@@ -55,13 +111,7 @@ def get_user_by_id(user_id):
     conn.close()
 
     if row:
-        return User(
-            row["id"],
-            row["username"],
-            row["password_hash"],
-            row.get("role"),
-            row.get("is_active", 1),
-            row.get("created_at"),
-            row.get("last_login")
-        )
+        user = _row_to_user(row)
+        _cache_put(user)
+        return user
     return None
@@ -0,0 +1,196 @@
+from collections import OrderedDict, deque
+from datetime import timedelta
+import re
+
+# Pattern rules (rule_type = 'pattern') are compiled together so each log row
+# is scanned once no matter how many rules exist: literal "contains" values go
+# into one Aho-Corasick automaton per log field, "equals" values into a dict,
+# and regexes into one combined alternation that is used as a prefilter before
+# the individual patterns are tried. Only patterns without capture groups or
+# leading inline flags go into the alternation: joining those would renumber
+# backreferences, clash on group names, or put a global flag mid-pattern.
+# Those patterns are tried on their own for every row. Matching is
+# case-insensitive, like the LIKE / REGEXP comparisons threshold rules run in
+# MySQL.
+
+MAX_COUNTER_ENTRIES = 100000
+
+LOG_FIELDS = ("source", "level", "ip_address", "message")
+
+_GLOBAL_FLAGS = re.compile(r"\(\?[aiLmsux]+\)")
+
+
+# ================= AHO-CORASICK =================
+
+class AhoCorasick:
+    def __init__(self, keywords):
+        """keywords: iterable of (keyword, payload) pairs."""
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]
+
+        for keyword, payload in keywords:
+            node = 0
+            for ch in keyword:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(())
+                    self.goto[node][ch] = nxt
+                node = nxt
+            self.out[node] += (payload,)
+
+        # Breadth-first pass to link each state to its longest proper suffix
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self.goto[node].items():
+                queue.append(child)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[child] = self.goto[f].get(ch, 0)
+                self.out[child] += self.out[self.fail[child]]
+
+    def search(self, text):
+        """Return the set of payloads whose keyword occurs in text."""
+        goto, fail, out = self.goto, self.fail, self.out
+        found = set()
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                found.update(out[node])
+        return found
+
+# ================= RULE MATCHER =================
+
+class PatternMatcher:
+    def __init__(self):
+        self.rules = {}         # rule id -> rule row
+        self._signature = None
+        # log field -> (automaton, equals dict, combined regex, [(regex, id)] behind
+        # the combined prefilter, [(regex, id)] tried on every row)
+        self._fields = {}
+
+    def set_rules(self, rules):
+        """Rebuild the matcher only when the set of pattern rules has changed."""
+        signature = tuple(sorted(
+            (r["id"], r["rule_name"], r["log_field"], r["match_type"], r["match_value"],
+             r["threshold"], r["time_window_minutes"], r["severity"])
+            for r in rules
+        ))
+        if signature == self._signature:
+            return False
+
+        literals, equals, regexes = {}, {}, {}
+        active = {}
+        for rule in rules:
+            field = rule["log_field"]
+            value = rule["match_value"]
+            if field not in LOG_FIELDS or not value:
+                print(f"[PATTERN] Skipping rule {rule['rule_name']}: invalid field or value")
+                continue
+
+            if rule["match_type"] == "regex":
+                try:
+                    regexes.setdefault(field, []).append((re.compile(value, re.IGNORECASE), rule["id"]))
+                except re.error as e:
+                    print(f"[PATTERN] Skipping rule {rule['rule_name']}: {e}")
+                    continue
+            elif rule["match_type"] == "equals":
+                equals.setdefault(field, {}).setdefault(value.lower(), set()).add(rule["id"])
+            else:  # contains
+                literals.setdefault(field, []).append((value.lower(), rule["id"]))
+            active[rule["id"]] = rule
+
+        self._fields = {}
+        for field in set(literals) | set(equals) | set(regexes):
+            automaton = AhoCorasick(literals[field]) if field in literals else None
+            combined, prefiltered, individual = _combine(regexes.get(field, []))
+            self._fields[field] = (automaton, equals.get(field, {}), combined, prefiltered, individual)
+
+        self.rules = active
+        self._signature = signature
+        return True
+
+    def match(self, event):
+        """Return the ids of all pattern rules matching this log row."""
+        matched = set()
+        for field, (automaton, equals, combined, prefiltered, individual) in self._fields.items():
+            value = event.get(field)
+            if value is None:
+                continue
+            value = str(value)
+            lowered = value.lower()
+
+            if automaton is not None:
+                matched |= automaton.search(lowered)
+            if lowered in equals:
+                matched |= equals[lowered]
+            if combined is not None and combined.search(value):
+                matched.update(rule_id for p, rule_id in prefiltered if p.search(value))
+            matched.update(rule_id for p, rule_id in individual if p.search(value))
+        return matched
+
+
+def _combine(patterns):
+    """Split compiled patterns into (combined prefilter, patterns behind it, patterns tried alone)."""
+    prefiltered, individual = [], []
+    for p, rule_id in patterns:
+        if p.groups or _GLOBAL_FLAGS.match(p.pattern):
+            individual.append((p, rule_id))
+        else:
+            prefiltered.append((p, rule_id))
+
+    if len(prefiltered) < 2:
+        return None, [], patterns
+    try:
+        combined = re.compile("|".join(f"(?:{p.pattern})" for p, _ in prefiltered), re.IGNORECASE)
+    except re.error as e:
+        print(f"[PATTERN] Matching regexes one by one, could not combine them: {e}")
+        return None, [], patterns
+    return combined, prefiltered, individual
+
+# ================= HIT COUNTING =================
+
+class PatternHitCounter:
+    """Sliding-window hit counts per (rule, IP), capped with LRU eviction."""
+
+    def __init__(self, max_entries=MAX_COUNTER_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = OrderedDict()   # (rule id, ip) -> deque of match times
+        self.evicted = 0
+
+    def add(self, rule, ip, when):
+        """Record a hit; return the hit count if the rule's threshold was reached, else None."""
+        key = (rule["id"], ip)
+        window = timedelta(minutes=rule["time_window_minutes"])
+
+        times = self.hits.get(key)
+        if times is None:
+            times = self.hits[key] = deque()
+            if len(self.hits) > self.max_entries:
+                self.hits.popitem(last=False)
+                self.evicted += 1
+        else:
+            self.hits.move_to_end(key)
+
+        times.append(when)
+        while when - times[0] > window:
+            times.popleft()
+
+        if len(times) >= (rule["threshold"] or 1):
+            count = len(times)
+            del self.hits[key]
+            return count
+        return None
+
+    def keep_rules(self, rule_ids):
+        """Forget counts for rules that are no longer active."""
+        for key in [k for k in self.hits if k[0] not in rule_ids]:
+            del self.hits[key]
@@ -0,0 +1,333 @@
+from datetime import datetime
+import threading
+import struct
+import json
+import time
+import zlib
+import os
+
+try:
+    import fcntl
+except ImportError:  # no file locks on Windows; run one ingest process per spool there
+    fcntl = None
+
+# Durable on-disk buffer for log batches the database cannot take right now.
+#
+# Batches are appended as frames (length, CRC32, JSON payload) to segment
+# files named by creation time. Writers fsync in groups: a thread that
+# appends waits until its frame is on disk, but one fsync covers every frame
+# appended while the previous fsync was running, so concurrent requests share
+# the cost. A segment is closed when it reaches SPOOL_SEGMENT_BYTES or is
+# SPOOL_ROLL_SECONDS old, and only closed segments are replayed.
+#
+# The replayer drains closed segments oldest first in batches of up to
+# REPLAY_BATCH_SIZE rows and records (segment, offset) in a checkpoint file
+# after every committed batch, so a restart resumes where it stopped. Delivery
+# is at-least-once: a crash between a commit and its checkpoint replays that
+# one batch again. Several processes (web app, syslog receiver) can share the
+# spool directory; each writes its own segments and a lock file makes sure
+# only one of them replays at a time.
+#
+# The size cap is checked against a byte count kept in memory (added to on
+# append, reduced when this process replays a segment) so appends never scan
+# the directory. The replayer thread re-reads the real size every
+# REPLAY_INTERVAL to pick up segments written or replayed by other processes.
+
+SPOOL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "spool")
+SPOOL_MAX_BYTES = 1024 * 1024 * 1024    # appends fail with SpoolFull beyond this
+SPOOL_SEGMENT_BYTES = 16 * 1024 * 1024
+SPOOL_ROLL_SECONDS = 5
+REPLAY_BATCH_SIZE = 5000
+REPLAY_INTERVAL = 2
+
+SEGMENT_SUFFIX = ".seg"
+CHECKPOINT_FILE = "checkpoint.json"
+REPLAY_LOCK_FILE = "replay.lock"
+REJECTED_FILE = "rejected.ndjson"
+
+_FRAME_HEADER = struct.Struct(">II")    # payload length, CRC32 of payload
+
+
+class SpoolFull(Exception):
+    pass
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            # log_time is stored as local time without a zone
+            value = value.astimezone().replace(tzinfo=None)
+        return value.isoformat(sep=" ")
+    return str(value)
+
+
+def encode_frame(records):
+    payload = json.dumps(records, default=_json_default, separators=(",", ":")).encode("utf-8")
+    return _FRAME_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_frames(fp):
+    """Yield (records, end offset) for each intact frame; stop at a torn or corrupt one."""
+    while True:
+        header = fp.read(_FRAME_HEADER.size)
+        if len(header) < _FRAME_HEADER.size:
+            return
+        length, crc = _FRAME_HEADER.unpack(header)
+        payload = fp.read(length)
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            return
+        yield json.loads(payload), fp.tell()
+
+
+def _try_lock(fd):
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+# ================= SPOOL =================
+
+class Spool:
+    def __init__(self, directory=SPOOL_DIR, max_bytes=SPOOL_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()       # segment file, sequence numbers
+        self._sync_lock = threading.Lock()  # one fsync at a time
+        self._fd = None
+        self._segment = None
+        self._segment_bytes = 0
+        self._opened_at = 0.0
+        self._written_seq = 0
+        self._synced_seq = 0
+        self._size = None                   # bytes in all segments; scanned on first append
+        self._appended = 0                  # bytes this process has appended in total
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def segments(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(n for n in names if n.endswith(SEGMENT_SUFFIX))
+
+    def size(self):
+        total = 0
+        for name in self.segments():
+            try:
+                total += os.path.getsize(self._path(name))
+            except FileNotFoundError:
+                pass
+        return total
+
+    def refresh_size(self):
+        """Re-read the tracked size from disk, counting appends made during the scan."""
+        with self._lock:
+            appended = self._appended
+        total = self.size()
+        with self._lock:
+            self._size = total + self._appended - appended
+
+    # ----------------- writing -----------------
+
+    def _open_segment(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._segment = f"{time.time_ns():020d}-{os.getpid()}{SEGMENT_SUFFIX}"
+        self._fd = os.open(self._path(self._segment), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        # Held until the segment is closed, so the replayer leaves it alone
+        _try_lock(self._fd)
+        self._segment_bytes = 0
+        self._opened_at = time.monotonic()
+
+    def _close_segment(self):
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._fd = None
+        self._segment = None
+        self._synced_seq = self._written_seq
+
+    def append(self, records):
+        """Durably append one batch of records; raises SpoolFull when over the size cap."""
+        frame = encode_frame(records)
+
+        with self._lock:
+            if self._size is None:
+                self._size = self.size()
+            if self._size + len(frame) > self.max_bytes:
+                raise SpoolFull(f"spool is over {self.max_bytes} bytes")
+            if self._fd is not None and (
+                self._segment_bytes + len(frame) > SPOOL_SEGMENT_BYTES
+                or time.monotonic() - self._opened_at > SPOOL_ROLL_SECONDS
+            ):
+                self._close_segment()
+            if self._fd is None:
+                self._open_segment()
+
+            os.write(self._fd, frame)
+            self._segment_bytes += len(frame)
+            self._size += len(frame)
+            self._appended += len(frame)
+            self._written_seq += 1
+            ticket = self._written_seq
+
+        self._sync(ticket)
+
+    def _sync(self, ticket):
+        """Return once frame `ticket` is on disk, sharing one fsync between concurrent appenders."""
+        with self._sync_lock:
+            with self._lock:
+                if self._synced_seq >= ticket:
+                    return
+                target = self._written_seq
+                fd = os.dup(self._fd)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            with self._lock:
+                self._synced_seq = max(self._synced_seq, target)
+
+    def roll_if_idle(self):
+        """Close this process's segment once it is old enough so it can be replayed."""
+        with self._lock:
+            if self._fd is not None and time.monotonic() - self._opened_at > SPOOL_ROLL_SECONDS:
+                self._close_segment()
+
+    # ----------------- replay -----------------
+
+    def _load_checkpoint(self):
+        try:
+            with open(self._path(CHECKPOINT_FILE)) as f:
+                data = json.load(f)
+            return data["segment"], data["offset"]
+        except (FileNotFoundError, ValueError, KeyError):
+            return None, 0
+
+    def _save_checkpoint(self, segment, offset):
+        tmp = self._path(CHECKPOINT_FILE + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump({"segment": segment, "offset": offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path(CHECKPOINT_FILE))
+
+    def _reject(self, records, error):
+        with open(self._path(REJECTED_FILE), "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, default=_json_default) + "\n")
+        print(f"[SPOOL] Moved {len(records)} unwritable records to {REJECTED_FILE}: {error}")
+
+    def _write_batch(self, write, frames, is_unavailable):
+        """Write frames in one call; if the data itself is rejected, retry them one by one."""
+        try:
+            write([r for records in frames for r in records])
+        except Exception as e:
+            if is_unavailable(e):
+                raise
+            if len(frames) == 1:
+                self._write_each(write, frames[0], is_unavailable)
+                return
+            for records in frames:
+                self._write_batch(write, [records], is_unavailable)
+
+    def _write_each(self, write, records, is_unavailable):
+        """Write a rejected frame row by row, moving only the rows that still fail to REJECTED_FILE."""
+        rejected, error = [], None
+        for record in records:
+            try:
+                write([record])
+            except Exception as e:
+                if is_unavailable(e):
+                    raise
+                rejected.append(record)
+                error = e
+        if rejected:
+            self._reject(rejected, error)
+
+    def replay(self, write, is_unavailable=lambda e: True):
+        """Drain closed segments through write(records); return the number of records replayed.
+
+        Stops at the first error for which is_unavailable(error) is true and
+        leaves the rest for the next call. Other errors mean the batch itself
+        is bad; its frames are retried one at a time, the rows of a frame that
+        still fails one at a time, and only the rows that fail on their own
+        are moved to REJECTED_FILE.
+        """
+        if not os.path.isdir(self.directory):
+            return 0
+
+        lock_fd = os.open(self._path(REPLAY_LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if not _try_lock(lock_fd):
+                return 0    # another process is replaying
+
+            replayed = 0
+            checkpoint_segment, checkpoint_offset = self._load_checkpoint()
+
+            for name in self.segments():
+                if name == self._segment:
+                    continue
+                path = self._path(name)
+                try:
+                    fd = os.open(path, os.O_RDONLY)
+                except FileNotFoundError:
+                    continue
+
+                with os.fdopen(fd, "rb") as fp:
+                    if not _try_lock(fd):
+                        continue    # still open in its writer process
+
+                    start = checkpoint_offset if name == checkpoint_segment else 0
+                    fp.seek(start)
+
+                    frames, rows, offset = [], 0, start
+                    for records, end in read_frames(fp):
+                        frames.append(records)
+                        rows += len(records)
+                        offset = end
+                        if rows >= REPLAY_BATCH_SIZE:
+                            self._write_batch(write, frames, is_unavailable)
+                            self._save_checkpoint(name, offset)
+                            replayed += rows
+                            frames, rows = [], 0
+                    if frames:
+                        self._write_batch(write, frames, is_unavailable)
+                        self._save_checkpoint(name, offset)
+                        replayed += rows
+
+                    size = os.fstat(fd).st_size
+                    if offset < size:
+                        print(f"[SPOOL] Skipping {size - offset} corrupt bytes at the end of {name}")
+
+                os.remove(path)
+                with self._lock:
+                    if self._size is not None:
+                        self._size = max(0, self._size - size)
+
+            return replayed
+        finally:
+            os.close(lock_fd)
+
+
+def start_replayer(spool, write, is_unavailable=lambda e: True):
+    """Run spool.replay(write) every REPLAY_INTERVAL seconds in a daemon thread."""
+    def run():
+        while True:
+            time.sleep(REPLAY_INTERVAL)
+            try:
+                spool.roll_if_idle()
+                replayed = spool.replay(write, is_unavailable)
+                spool.refresh_size()
+                if replayed:
+                    print(f"[SPOOL] Replayed {replayed} spooled records")
+            except Exception as e:
+                print(f"[SPOOL] Replay paused: {e}")
+
+    thread = threading.Thread(target=run, name="spool-replayer", daemon=True)
+    thread.start()
+    return thread
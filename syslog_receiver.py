@@ -0,0 +1,255 @@
+import asyncio
+import re
+import time
+from datetime import datetime
+
+from ingest import save_logs, start_spool_replayer, start_summary_flusher
+
+# ================= RECEIVER CONFIG =================
+
+LISTEN_HOST = "0.0.0.0"
+UDP_PORT = 5514          # 514 needs root; point devices here or NAT 514 -> 5514
+TCP_PORT = 5514
+
+QUEUE_SIZE = 50000       # parsed events waiting for the DB writer
+BATCH_SIZE = 1000        # max rows per INSERT
+FLUSH_INTERVAL = 0.5     # seconds to wait before flushing a partial batch
+MAX_MESSAGE_SIZE = 65536
+STATS_INTERVAL = 60
+
+# Counters printed every STATS_INTERVAL seconds. Anything that does not make
+# it into the logs table is counted under one of the dropped_* / *_errors keys.
+stats = {
+    "received": 0,
+    "written": 0,
+    "dropped_queue_full": 0,
+    "dropped_write_error": 0,
+    "parse_errors": 0,
+}
+
+# ================= SYSLOG PARSING =================
+
+# syslog severity (PRI % 8) -> logs.level
+SEVERITY_LEVELS = {
+    0: "CRITICAL",  # emergency
+    1: "CRITICAL",  # alert
+    2: "CRITICAL",  # critical
+    3: "ERROR",
+    4: "WARNING",
+    5: "INFO",      # notice
+    6: "INFO",
+    7: "INFO",      # debug
+}
+
+PRI_RE = re.compile(r"<(\d{1,3})>")
+
+# <PRI>1 TIMESTAMP HOSTNAME APP-NAME PROCID MSGID [SD] MSG
+RFC5424_RE = re.compile(
+    r"1 (\S+) (\S+) (\S+) \S+ \S+ (-|(?:\[(?:[^\]\\]|\\.)*\])+) ?(.*)",
+    re.DOTALL
+)
+
+# <PRI>Mmm dd hh:mm:ss HOSTNAME MSG
+RFC3164_RE = re.compile(
+    r"([A-Z][a-z]{2}) +(\d{1,2}) (\d{2}):(\d{2}):(\d{2}) (\S+) (.*)",
+    re.DOTALL
+)
+
+MONTHS = {m: i for i, m in enumerate(
+    ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"], 1
+)}
+
+
+def _parse_rfc5424_time(value):
+    if value == "-":
+        return datetime.now()
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    ts = datetime.fromisoformat(value)
+    if ts.tzinfo is not None:
+        # logs.log_time is stored as local time without a zone
+        ts = ts.astimezone().replace(tzinfo=None)
+    return ts.replace(microsecond=0)
+
+
+def _parse_rfc3164_time(month, day, hour, minute, second):
+    now = datetime.now()
+    ts = datetime(now.year, MONTHS[month], int(day), int(hour), int(minute), int(second))
+    # RFC 3164 has no year; a timestamp far in the future is from last December
+    if (ts - now).days > 1:
+        ts = ts.replace(year=now.year - 1)
+    return ts
+
+
+def parse_syslog(data, peer_ip):
+    """Parse one RFC 3164 or RFC 5424 message into a logs record, or return None."""
+    text = data.decode("utf-8", errors="replace").rstrip("\r\n\x00")
+    if text.startswith("\ufeff"):
+        text = text[1:]
+
+    match = PRI_RE.match(text)
+    if not match:
+        return None
+    pri = int(match.group(1))
+    if pri > 191:
+        return None
+    level = SEVERITY_LEVELS[pri & 7]
+    rest = text[match.end():]
+
+    m = RFC5424_RE.match(rest)
+    if m:
+        timestamp, hostname, app_name, _sd, msg = m.groups()
+        try:
+            log_time = _parse_rfc5424_time(timestamp)
+        except ValueError:
+            log_time = datetime.now()
+        if msg.startswith("\ufeff"):
+            msg = msg[1:]
+        if app_name != "-":
+            msg = f"{app_name}: {msg}"
+        source = hostname if hostname != "-" else peer_ip
+    else:
+        m = RFC3164_RE.match(rest)
+        if m:
+            month, day, hour, minute, second, source, msg = m.groups()
+            try:
+                log_time = _parse_rfc3164_time(month, day, hour, minute, second)
+            except (KeyError, ValueError):
+                log_time = datetime.now()
+        else:
+            # No usable header; keep the payload rather than losing the event
+            source, msg, log_time = peer_ip, rest, datetime.now()
+
+    return {
+        "source": source,
+        "level": level,
+        "message": msg,
+        "ip": peer_ip,
+        "timestamp": log_time,
+    }
+
+
+def enqueue(queue, data, peer_ip):
+    stats["received"] += 1
+    record = parse_syslog(data, peer_ip)
+    if record is None:
+        stats["parse_errors"] += 1
+        return
+    try:
+        queue.put_nowait(record)
+    except asyncio.QueueFull:
+        stats["dropped_queue_full"] += 1
+
+# ================= UDP LISTENER =================
+
+class SyslogUDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, queue):
+        self.queue = queue
+
+    def datagram_received(self, data, addr):
+        enqueue(self.queue, data, addr[0])
+
+# ================= TCP LISTENER =================
+
+async def handle_tcp_client(reader, writer, queue):
+    """Read RFC 6587 framed messages: octet-counted ("LEN MSG") or newline-delimited."""
+    peer_ip = writer.get_extra_info("peername")[0]
+    try:
+        while True:
+            first = await reader.read(1)
+            if not first:
+                break
+
+            if first.isdigit():
+                length_bytes = first + await reader.readuntil(b" ")
+                length = int(length_bytes[:-1])
+                if length > MAX_MESSAGE_SIZE:
+                    stats["parse_errors"] += 1
+                    break
+                data = await reader.readexactly(length)
+            else:
+                data = first + await reader.readuntil(b"\n")
+
+            enqueue(queue, data, peer_ip)
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+# ================= BATCH WRITER =================
+
+async def batch_writer(queue):
+    loop = asyncio.get_running_loop()
+
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + FLUSH_INTERVAL
+
+        while len(batch) < BATCH_SIZE:
+            # Drain what is already queued without a task per event; only
+            # wait (with the flush deadline) once the queue is empty
+            try:
+                batch.append(queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # mysql-connector is blocking, so keep it off the event loop. Batches
+        # go to the disk spool if the database is down; they only count as
+        # dropped if the spool is full too.
+        try:
+            written = await loop.run_in_executor(None, save_logs, batch)
+            stats["written"] += written
+            stats["dropped_write_error"] += len(batch) - written
+        except Exception as e:
+            stats["dropped_write_error"] += len(batch)
+            print(f"[SYSLOG] Failed to write batch of {len(batch)}: {e}")
+
+
+async def report_stats(queue):
+    while True:
+        await asyncio.sleep(STATS_INTERVAL)
+        print(
+            f"[SYSLOG] {time.strftime('%Y-%m-%d %H:%M:%S')} queue={queue.qsize()} "
+            + " ".join(f"{k}={v}" for k, v in stats.items())
+        )
+
+# ================= MAIN =================
+
+async def main():
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    await loop.create_datagram_endpoint(
+        lambda: SyslogUDPProtocol(queue), local_addr=(LISTEN_HOST, UDP_PORT)
+    )
+    server = await asyncio.start_server(
+        lambda r, w: handle_tcp_client(r, w, queue), LISTEN_HOST, TCP_PORT,
+        limit=MAX_MESSAGE_SIZE
+    )
+
+    start_spool_replayer()
+    start_summary_flusher()
+
+    print(f"Syslog receiver listening on udp/{UDP_PORT} and tcp/{TCP_PORT}...")
+
+    async with server:
+        await asyncio.gather(
+            server.serve_forever(),
+            batch_writer(queue),
+            report_stats(queue),
+        )
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta
+import random
+
+from pattern_matcher import AhoCorasick, PatternMatcher, PatternHitCounter
+
+
+def make_rule(rule_id, match_type, value, field="message", threshold=1, window=5):
+    return {
+        "id": rule_id,
+        "rule_name": f"rule-{rule_id}",
+        "log_field": field,
+        "match_type": match_type,
+        "match_value": value,
+        "threshold": threshold,
+        "time_window_minutes": window,
+        "severity": "HIGH",
+    }
+
+
+def matcher_for(*rules):
+    matcher = PatternMatcher()
+    matcher.set_rules(list(rules))
+    return matcher
+
+# ================= AHO-CORASICK =================
+
+def test_aho_corasick_finds_overlapping_keywords():
+    automaton = AhoCorasick([("he", 1), ("she", 2), ("his", 3), ("hers", 4)])
+    assert automaton.search("ushers") == {1, 2, 4}
+    assert automaton.search("this") == {3}
+    assert automaton.search("nothing") == set()
+
+
+def test_aho_corasick_matches_brute_force():
+    rng = random.Random(7)
+    keywords = ["".join(rng.choice("ab") for _ in range(rng.randint(1, 4))) for _ in range(20)]
+    automaton = AhoCorasick((k, i) for i, k in enumerate(keywords))
+    for _ in range(200):
+        text = "".join(rng.choice("abc") for _ in range(rng.randint(0, 15)))
+        expected = {i for i, k in enumerate(keywords) if k in text}
+        assert automaton.search(text) == expected
+
+# ================= PATTERN MATCHER =================
+
+def test_equals_contains_and_regex_are_case_insensitive():
+    matcher = matcher_for(
+        make_rule(1, "equals", "ERROR", field="level"),
+        make_rule(2, "contains", "Failed Password"),
+        make_rule(3, "regex", r"user \w+ locked"),
+    )
+    assert matcher.match({"level": "error", "message": "failed password for root"}) == {1, 2}
+    assert matcher.match({"level": "INFO", "message": "User ROOT LOCKED out"}) == {3}
+    assert matcher.match({"level": "info", "message": "login ok"}) == set()
+
+
+def test_regex_with_inline_flags():
+    matcher = matcher_for(make_rule(1, "regex", "(?i)failed"), make_rule(2, "regex", "denied"))
+    assert matcher.match({"message": "FAILED login"}) == {1}
+    assert matcher.match({"message": "access denied"}) == {2}
+
+
+def test_regexes_with_the_same_group_name():
+    matcher = matcher_for(
+        make_rule(1, "regex", "(?P<u>root)"),
+        make_rule(2, "regex", "(?P<u>admin)"),
+        make_rule(3, "regex", "sudo"),
+    )
+    assert matcher.match({"message": "login as admin"}) == {2}
+    assert matcher.match({"message": "root via sudo"}) == {1, 3}
+
+
+def test_regexes_with_backreferences():
+    matcher = matcher_for(make_rule(1, "regex", r"(a)\1"), make_rule(2, "regex", r"(b)\1"))
+    assert matcher.match({"message": "bb"}) == {2}
+    assert matcher.match({"message": "aab"}) == {1}
+    assert matcher.match({"message": "ab"}) == set()
+
+
+def test_invalid_regex_skips_only_that_rule():
+    matcher = matcher_for(make_rule(1, "regex", "(unclosed"), make_rule(2, "contains", "error"))
+    assert set(matcher.rules) == {2}
+    assert matcher.match({"message": "(unclosed error"}) == {2}
+
+
+def test_set_rules_only_rebuilds_on_change():
+    matcher = PatternMatcher()
+    rules = [make_rule(1, "contains", "error")]
+    assert matcher.set_rules(rules) is True
+    assert matcher.set_rules(rules) is False
+    assert matcher.set_rules([make_rule(1, "contains", "warning")]) is True
+
+# ================= HIT COUNTING =================
+
+def test_hit_counter_reports_threshold_within_window():
+    rule = make_rule(1, "contains", "error", threshold=3, window=1)
+    counter = PatternHitCounter()
+    start = datetime(2026, 1, 1, 12, 0)
+
+    assert counter.add(rule, "10.0.0.1", start) is None
+    assert counter.add(rule, "10.0.0.1", start + timedelta(seconds=90)) is None
+    # The first hit has left the one-minute window
+    assert counter.add(rule, "10.0.0.1", start + timedelta(seconds=100)) is None
+    assert counter.add(rule, "10.0.0.1", start + timedelta(seconds=110)) == 3